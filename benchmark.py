@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+""" Benchmark route building, simulation ticks and frame drawing.
+
+Scenarios cover bundled maps and synthetic serpentine maps of larger size,
+from 30 to 10000 creeps and from no towers to every buildable cell filled
+with towers of one type. For each scenario ticks per second, time of every
+tick phase and peak memory are reported, and all results can be saved to
+JSON file and compared with results of previous run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import curses_td
+from curses_td import (CursesRenderer, Cursor, GameField, NullRenderer,
+                       make_engine)
+
+
+BUNDLED_MAPS = [curses_td.MAP_FILE % (level,) for level in range(1, 6)]
+TOWER_TYPES = sorted(curses_td.PRICES)
+
+# creeps in tick scenarios are practically immortal, so population is stable
+CREEP_HP = 10 ** 12
+CREEP = (CREEP_HP, curses_td.START_CREEP_REWARD, curses_td.START_CREEP_SPEED, False)
+
+PHASES = ('effects', 'spawn', 'attack', 'remove_dead', 'move')
+
+
+class CountingScreen():
+
+    """ Screen which only counts calls, to measure drawing without terminal. """
+
+    def __init__(self):
+        self.addstr_calls = 0
+        self.refresh_calls = 0
+
+    def addstr(self, *args):
+        self.addstr_calls += 1
+
+    def refresh(self):
+        self.refresh_calls += 1
+
+
+class BenchmarkRenderer(CursesRenderer):
+
+    """ CursesRenderer which does not need initialized curses for colors. """
+
+    def color(self, color):
+        return color
+
+
+def serpentine_map(size):
+    """ Square map with one long path snaking between rows of tower cells. """
+    field = [['b'] * size for _ in range(size)]
+    path_rows = list(range(1, size - 1, 2))
+    for n, row in enumerate(path_rows):
+        for col in range(1, size - 1):
+            field[row][col] = '.'
+        if row + 1 < size - 1:
+            for col in range(1, size - 1):
+                field[row + 1][col] = 'w'
+            # gap to the next path row, alternating sides
+            field[row + 1][size - 2 if n % 2 == 0 else 1] = '.'
+    field[path_rows[0]][1] = 's'
+    last = path_rows[-1]
+    field[last][size - 2 if len(path_rows) % 2 else 1] = 'e'
+    return field
+
+
+def write_map(field, directory, name):
+    filename = os.path.join(directory, name)
+    with open(filename, 'w') as f:
+        for line in field:
+            f.write(' '.join(line) + '\n')
+    return filename
+
+
+def setup_scenario(map_name, creeps, towers, backend):
+    """ Engine with given creeps spread along the path and towers built. """
+    engine = make_engine(backend, seed=0)
+    engine.setup_map(map_name, 'easy')
+    engine.lifes = float('inf')
+    engine.gold = float('inf')
+    if towers:
+        for row in range(engine.field_rows):
+            for col in range(engine.field_cols):
+                engine.build_tower(towers, row, col)
+    for n in range(creeps):
+        engine.spawn_creep(engine.spawns[n % len(engine.spawns)], CREEP)
+    # spread creeps along the path, avoiding the end cell
+    last = len(engine.creep_path) - 2
+    for n, creep in enumerate(engine.creeps):
+        set_path_index(engine, n, creep, n * last // max(creeps, 1))
+    engine.count_creeps()
+    return engine
+
+
+def set_path_index(engine, n, creep, path_index):
+    if hasattr(engine.creeps, '_path_index'):
+        engine.creeps._path_index[n] = path_index
+    else:
+        creep.path_index = path_index
+        creep.row, creep.col = engine.creep_path[path_index]
+
+
+def run_ticks(engine, creeps, ticks, time_limit):
+    """ Run tick phases one by one, measuring each of them. """
+    phases = dict.fromkeys(PHASES, 0.0)
+    clock = time.perf_counter
+    done = 0
+    start = clock()
+    while done < ticks and clock() - start < time_limit:
+        engine.ticks += 1
+        start_tick = clock()
+        engine.expire_effects()
+        t0 = clock()
+        for n in range(creeps - len(engine.creeps)):
+            engine.spawn_creep(engine.spawns[n % len(engine.spawns)], CREEP)
+        t1 = clock()
+        engine.attack_creeps()
+        t2 = clock()
+        engine.remove_dead_creeps()
+        t3 = clock()
+        engine.move_creeps()
+        t4 = clock()
+        phases['effects'] += t0 - start_tick
+        phases['spawn'] += t1 - t0
+        phases['attack'] += t2 - t1
+        phases['remove_dead'] += t3 - t2
+        phases['move'] += t4 - t3
+        done += 1
+    total = sum(phases.values())
+    return {'ticks': done,
+            'ticks_per_sec': round(done / total, 1) if total else None,
+            'phase_us': {name: round(value / done * 1e6, 2)
+                         for name, value in phases.items()}}
+
+
+def peak_memory(function, *args):
+    """ Peak memory in bytes allocated while function runs. """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_route(map_name, repeat):
+    """ Time parsing map and building route, and loading compiled map. """
+    def build(use_cache=False):
+        GameField.route_cache.clear()
+        field = GameField()
+        field.load(map_name, use_cache)
+        field.build_route()
+        return field
+    start = time.perf_counter()
+    for _ in range(repeat):
+        field = build()
+    seconds = (time.perf_counter() - start) / repeat
+    # the first load compiles map
+    build(True)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        build(True)
+    cached_seconds = (time.perf_counter() - start) / repeat
+    return {'route_ms': round(seconds * 1000, 3),
+            'compiled_load_ms': round(cached_seconds * 1000, 3),
+            'path_length': len(field.creep_path),
+            'peak_memory': peak_memory(build)}
+
+
+def bench_ticks(map_name, creeps, towers, backend, ticks, time_limit):
+    engine = setup_scenario(map_name, creeps, towers, backend)
+    result = run_ticks(engine, creeps, ticks, time_limit)
+    result['towers_built'] = len(engine.towers)
+    result['peak_memory'] = peak_memory(
+        lambda: run_ticks(setup_scenario(map_name, creeps, towers, backend),
+                          creeps, 5, time_limit))
+    return result
+
+
+def bench_frame(map_name, creeps, towers, renderer_name, frames):
+    """ Time drawing of frames while game goes on, count addstr calls. """
+    engine = setup_scenario(map_name, creeps, towers, 'python')
+    screen = CountingScreen()
+    renderer = (NullRenderer() if renderer_name == 'null'
+                else BenchmarkRenderer(screen))
+    cursor = Cursor(0, 0, engine.field_rows, engine.field_cols)
+    spent = 0.0
+    for frame in range(frames):
+        engine.attack_creeps()
+        engine.move_creeps()
+        if renderer_name == 'full':
+            renderer.invalidate()
+        if frame % 10 == 0:
+            cursor.move_right()
+        start = time.perf_counter()
+        renderer.draw(engine, cursor)
+        spent += time.perf_counter() - start
+    return {'frame_us': round(spent / frames * 1e6, 2),
+            'addstr_per_frame': round(screen.addstr_calls / frames, 1)}
+
+
+def scenarios(args, maps):
+    """ Yield (name, function, arguments) of benchmarks to run. """
+    sizes = [25] if args.quick else [25, 100, 200]
+    creep_counts = [30, 1000] if args.quick else [30, 300, 1000, 10000]
+    tower_sets = [None] + TOWER_TYPES
+    for map_name in BUNDLED_MAPS + [maps[size] for size in sizes]:
+        yield ('route %s' % os.path.basename(map_name), bench_route,
+               (map_name, 3 if args.quick else 20))
+    for map_name in BUNDLED_MAPS:
+        for towers in tower_sets:
+            yield ('ticks %s creeps=30 towers=%s' % (map_name, towers or 'none'),
+                   bench_ticks, (map_name, 30, towers, args.backend, args.ticks,
+                                 args.time_limit))
+    for size in sizes:
+        for creeps in creep_counts:
+            # full maps of towers only where number of towers is sane
+            for towers in (tower_sets if size <= 25 else [None]):
+                yield ('ticks synthetic%s creeps=%s towers=%s'
+                       % (size, creeps, towers or 'none'), bench_ticks,
+                       (maps[size], creeps, towers, args.backend, args.ticks,
+                        args.time_limit))
+    # on the biggest map only part of field in viewport is drawn
+    frame_maps = [(BUNDLED_MAPS[0], 'm'), (maps[25], 'm'), (maps[sizes[-1]], None)]
+    for map_name, towers in frame_maps[:2 if args.quick else 3]:
+        for renderer in ('full', 'dirty', 'null'):
+            yield ('frame %s renderer=%s' % (os.path.basename(map_name), renderer),
+                   bench_frame, (map_name, 30, towers, renderer, args.frames))
+
+
+def compare(results, previous):
+    """ Print ticks/sec and frame time change against previous run. """
+    old = {result['name']: result for result in previous['results']}
+    for result in results:
+        before = old.get(result['name'])
+        if not before:
+            continue
+        for key in ('ticks_per_sec', 'route_ms', 'compiled_load_ms', 'frame_us'):
+            if result.get(key) and before.get(key):
+                print('%-55s %-16s %12s -> %12s (%+.1f%%)'
+                      % (result['name'], key, before[key], result[key],
+                         (result[key] / before[key] - 1) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer and smaller scenarios')
+    parser.add_argument('--filter', default='',
+                        help='run only scenarios with this text in name')
+    parser.add_argument('--backend', choices=['python', 'numpy'],
+                        default='python')
+    parser.add_argument('--ticks', type=int, default=300,
+                        help='ticks per scenario at most')
+    parser.add_argument('--time-limit', type=float, default=2.0,
+                        help='seconds per scenario at most')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--output', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved by earlier run')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        maps = {size: write_map(serpentine_map(size), directory,
+                                'synthetic%s.txt' % (size,))
+                for size in (25, 100, 200)}
+        for name, function, arguments in scenarios(args, maps):
+            name = name.replace(directory + os.sep, '')
+            if args.filter not in name:
+                continue
+            result = function(*arguments)
+            result['name'] = name
+            results.append(result)
+            print(name, json.dumps({key: value for key, value in result.items()
+                                    if key != 'name'}))
+            sys.stdout.flush()
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(), 'backend': args.backend,
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+""" Validate map files and compile them for fast loading.
+
+Every map is checked: only cells known to the game, rows of equal length,
+spawn and exit cells present and a route from every spawn to an exit.
+Wave script saved next to a map, if any, is checked too.
+Valid maps are saved next to their text files in compiled form with field,
+creep path and flow field, which the game memory maps instead of parsing
+text. Game recompiles maps by itself when their text changes, this command
+is for checking maps ahead and reporting all errors at once.
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+import curses_td
+from curses_td import GameField, MapCache, MapError, WaveScript
+
+
+def compile_map(map_name, check_only=False):
+    """ Validate and compile one map, return description of result. """
+    field = GameField()
+    with open(map_name, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        field.parse(f.read())
+    field.build_route()
+    waves = WaveScript.load(map_name)
+    if not check_only:
+        MapCache.write(field, MapCache.filename(map_name), stat)
+    return '%sx%s cells, %s spawns, %s exits, %s route cells, %s rounds' % (
+        len(field.field), len(field.field[0]), len(field.starts),
+        len(field.ends), len(field.creep_path), waves.rounds or 'endless')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('maps', nargs='*', metavar='MAP',
+                        help='map text files (default: %s)'
+                             % (curses_td.MAP_FILE % ('*',),))
+    parser.add_argument('--check', action='store_true',
+                        help='only validate maps, do not write compiled files')
+    args = parser.parse_args(argv)
+
+    status = 0
+    for map_name in args.maps or sorted(glob.glob(curses_td.MAP_FILE % ('*',))):
+        try:
+            print('%s: %s' % (map_name, compile_map(map_name, args.check)))
+        except (MapError, OSError) as error:
+            print('%s: ERROR %s' % (map_name, error))
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 
-import copy
+import argparse
+import array
+import asyncio
+import bisect
+import collections
 import curses
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
 import random
+import struct
 import sys
 import time
+import zlib
 
 
+# size of visible part of map in cells, bigger maps are scrolled
 MAX_ROWS, MAX_COLS = 25, 25
+# cursor is kept that many cells away from edges of scrolled view
+SCROLL_MARGIN = 2
 CELL_WIDTH = 3
 
 # colors
@@ -28,6 +44,12 @@ FIELD_COLOR = {'.': WHITE, 'w': YELLOW, 's': RED, 'e': RED, 'b': BLUE}
 
 TIME_DELAY = 100
 
+MAP_FILE = 'map%s.txt'
+# compiled map is saved next to map text file with this extension
+COMPILED_MAP_EXT = '.tdmap'
+# wave script of a map is JSON file next to map text file with this extension
+WAVES_EXT = '.waves'
+
 START_GOLD = 50
 
 TOWERS = {'c': {'damage': 6, 'speed': 6, 'range': 1, 'images': TOWER_IMAGE_1},
@@ -49,7 +71,8 @@ CRIT_MULTIPLIER = 20
 TOWER_MAX_LEVEL = 10
 
 HELP_INFO = "c - chainsaw tower, m - minigun tower, s - sniper tower, i - ice tower\n"\
-            "u - upgrade tower, d - destroy tower, space - send creeps now\n"\
+            "u - upgrade tower, d - destroy tower, space - send creeps now, "\
+            "o - performance overlay\n"\
             "tower costs: chainsaw - %s, minigun - %s, sniper - %s, ice - %s" \
             % (PRICES['c'], PRICES['m'], PRICES['s'], PRICES['i'])
 
@@ -64,15 +87,27 @@ HELP_INFO_ROW = 30
 
 OBJECT_INFO_ROW = 5
 OBJECT_INFO_COL = 80
+PERF_INFO_ROW = 16
 
 TIME_BETWEEN_WAVES = 60
 
 FPS = 60
+MAX_CATCH_UP_TICKS = FPS
+# timed effects towers put on creeps: duration in ticks and what happens
+# when effect of the same kind is applied again:
+#   'strongest' - stronger value wins, equal or stronger one restarts duration
+#   'refresh' - new value replaces old one and restarts duration
+#   'stack' - values add up, every application expires on its own
+EFFECTS = {'slow': {'duration': FPS, 'stacking': 'strongest'}}
 ATTACK_SPEED_POINTS = 60
 MOVE_SPEED_POINTS = 60
 
 LIFES = 20
 
+AUTOSAVE_SECONDS = 5
+# every that many autosaves full snapshot is saved instead of delta
+FULL_SNAPSHOT_EVERY = 60
+
 MAX_ROUNDS = 50
 BOSS_ROUND = 10
 CREEP_COUNT = 30
@@ -88,111 +123,481 @@ CREEP_REWARD_UPGRADE = 1
 
 DIFFICULTY_HP_MULTIPLIER = {'easy': 0, 'medium': 0.25, 'hard': 0.5}
 
+# waves of maps without wave script, see WaveScript
+DEFAULT_WAVES = {
+    'rounds': MAX_ROUNDS,
+    'hp': {'start': START_CREEP_HP, 'add_per_round': CREEP_HP_LEVEL_MULTIPLIER},
+    'reward': {'start': START_CREEP_REWARD, 'add': CREEP_REWARD_UPGRADE},
+    'speed': {'start': START_CREEP_SPEED, 'add': CREEP_SPEED_UPGRADE},
+    'waves': [
+        {'every': BOSS_ROUND, 'grow': False,
+         'groups': [{'count': 1, 'boss': True, 'hp': BOSS_HP_MULTIPLY,
+                     'reward': BOSS_REWARD_MULTIPLY}]},
+        {'groups': [{'count': CREEP_COUNT}]},
+    ],
+}
+
+
+def build_key_commands():
+    """ Bind keys to player's commands. """
+    key_commands = {curses.KEY_UP: ('move', 'up'),
+                    curses.KEY_DOWN: ('move', 'down'),
+                    curses.KEY_LEFT: ('move', 'left'),
+                    curses.KEY_RIGHT: ('move', 'right')}
+    for keys, command in (('qQ', ('quit',)), ('pP', ('pause',)),
+                          (' ', ('send_wave',)),
+                          ('kK', ('move', 'up')), ('jJ', ('move', 'down')),
+                          ('hH', ('move', 'left')), ('lL', ('move', 'right')),
+                          ('cC', ('build', 'c')), ('mM', ('build', 'm')),
+                          ('sS', ('build', 's')), ('iI', ('build', 'i')),
+                          ('dD', ('destroy',)), ('uU', ('upgrade',)),
+                          ('oO', ('overlay',))):
+        for key in keys:
+            key_commands[ord(key)] = command
+    return key_commands
+
+
+KEY_COMMANDS = build_key_commands()
+
 
 class ExitGame(Exception):
     pass
 
 
-def is_number(string):
-    try:
-        _ = int(string)
-        return True
-    except:
-        return False
+class MapError(Exception):
+    """ Map file is malformed or creeps can not get from spawn to exit. """
+
+
+class SaveError(Exception):
+    """ Saved game can not be loaded. """
 
 
 class GameField():
 
-    """ Class designed to load map from file and find path for creeps. """
+    """ Class designed to load map from file and find path for creeps.
 
-    def __init__(self, field=None):
-        self.field = field
-        self.start_row = None
-        self.start_col = None
-        self.end_row = None
-        self.end_col = None
+    Every row of field is a string with one character per cell, so maps
+    of hundreds of rows and columns stay compact.
+    """
 
-    def load(self, filename):
-        """ Load map from file. """
-        with open(filename) as f:
-            self.field = [line.split() for line in f]
-
-    def find_cell(self, cell_value):
-        """ Find coordinates of cell with given value. """
-        for row in range(len(self.field)):
-            for col in range(len(self.field[row])):
-                if self.field[row][col] == cell_value:
-                    return (row, col)
-
-    def check_path(self, row, col):
-        """ Check if any move is possible from cell with given row and col. """
-        path = False
-        if is_number(self.route[row][col]):
-            value = int(self.route[row][col])
-            if row > 0 and self.route[row-1][col] in ('.', 'e'):
-                self.route[row-1][col] = value + 1
-                path = True
-            if row < len(self.route) - 1 and self.route[row+1][col] in ('.', 'e'):
-                self.route[row+1][col] = value + 1
-                path = True
-            if col > 0 and self.route[row][col-1] in ('.', 'e'):
-                self.route[row][col-1] = value + 1
-                path = True
-            if col < len(self.route[row]) - 1 and self.route[row][col+1] in ('.', 'e'):
-                self.route[row][col+1] = value + 1
-                path = True
-        return path
+    # Routes already built, keyed by hash of map content. Values are shared
+    # between all fields loaded from the same map and must not be modified.
+    route_cache = {}
 
-    def build_route(self):
-        """ Find route from start cell to end cell. """
-        try:
-            self.start_row, self.start_col = self.find_cell('s')
-        except:
-            raise Exception('Map is corrupted, can not find start point.')
+    def __init__(self, field=None):
+        self.field = field
+        self.digest = None
+        # (row, col) of spawn and exit cells
+        self.starts = None
+        self.ends = None
+        # flow field: distance to the nearest exit, -1 where no way out
+        self.route = None
+        # cells creeps walk through, ordered from spawns to exits
+        self.creep_path = None
+        # index in creep path of next cell after every cell, exits lead
+        # to themselves
+        self.path_next = None
+        # (row, col) -> index in creep path
+        self.path_indices = None
+        # indices in creep path of spawn cells
+        self.spawns = None
+        # path cells blocked by towers in maze mode
+        self.blocked = set()
+
+    def load(self, filename, use_cache=True):
+        """ Load map from file.
+
+        If compiled map next to it is up to date, field and routes are
+        taken from it at once, otherwise map is parsed, validated and
+        compiled again (routes are built right away in this case).
+        """
+        cache_name = MapCache.filename(filename)
+        with open(filename, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if use_cache and MapCache.read(self, cache_name, stat):
+                return
+            content = f.read()
+        self.parse(content)
+        if use_cache:
+            if MapCache.read(self, cache_name, stat, self.digest):
+                return
+            self.build_route()
+            MapCache.write(self, cache_name, stat)
+
+    def parse(self, content):
+        """ Read field from map text, raise MapError if it is malformed. """
+        self.digest = hashlib.sha1(content).hexdigest()
         try:
-            self.end_row, self.end_col = self.find_cell('e')
-        except:
-            raise Exception('Map is corrupted, can not find end point.')
+            lines = content.decode().splitlines()
+        except UnicodeDecodeError:
+            raise MapError('Map is corrupted, it is not a text file.')
+        self.field = [''.join(line.split()) for line in lines if line.strip()]
+        if not self.field:
+            raise MapError('Map is empty.')
+        for row, line in enumerate(self.field):
+            if len(line) != len(self.field[0]):
+                raise MapError('Map is corrupted, row %s has %s cells instead of %s.'
+                               % (row, len(line), len(self.field[0])))
+            for col, cell in enumerate(line):
+                if cell not in FIELD_IMAGE:
+                    raise MapError('Map is corrupted, unknown cell %r at row %s, col %s.'
+                                   % (cell, row, col))
+
+    def find_cells(self, cell_value):
+        """ Find coordinates of all cells with given value. """
+        return [(row, col)
+                for row in range(len(self.field))
+                for col in range(len(self.field[row]))
+                if self.field[row][col] == cell_value]
+
+    def neighbours(self, row, col):
+        """ Yield cells adjacent to cell with given row and col. """
+        if row > 0 and col < len(self.field[row-1]):
+            yield row-1, col
+        if row < len(self.field) - 1 and col < len(self.field[row+1]):
+            yield row+1, col
+        if col > 0:
+            yield row, col-1
+        if col < len(self.field[row]) - 1:
+            yield row, col+1
 
-        self.route = copy.deepcopy(self.field)
-        self.route[self.start_row][self.start_col] = 0
-        while True:
-            path = False
-            for row in range(len(self.route)):
-                for col in range(len(self.route[row])):
-                    path = True if self.check_path(row, col) else path
-            if is_number(self.route[self.end_row][self.end_col]):
-                break
-            if not path:
-                raise Exception('Bad map: can not build route from start to end.')
-                break
+    def build_route(self):
+        """ Find routes from every spawn cell to the nearest exit.
+
+        One breadth-first search from all exits at once fills flow field
+        in self.route with distance to the nearest exit (-1 for cells
+        creeps can not reach), then route from every spawn goes downhill
+        over it. Cells of all routes are numbered in creep path from the
+        furthest from exits, so bigger index always means closer to exit,
+        and self.path_next gives next cell of any route cell at once.
+        Result is cached per map content.
+        """
+        if self.digest in self.route_cache:
+            (self.starts, self.ends, self.route, self.creep_path, self.path_next,
+             self.path_indices, self.spawns) = self.route_cache[self.digest]
+            return
+        self.starts = self.find_cells('s')
+        if not self.starts:
+            raise MapError('Map is corrupted, can not find start point.')
+        self.ends = self.find_cells('e')
+        if not self.ends:
+            raise MapError('Map is corrupted, can not find end point.')
+
+        self.route = [array.array('i', [-1]) * len(line) for line in self.field]
+        for row, col in self.ends:
+            self.route[row][col] = 0
+        queue = collections.deque(self.ends)
+        while queue:
+            row, col = queue.popleft()
+            value = self.route[row][col] + 1
+            for next_row, next_col in self.neighbours(row, col):
+                if self.route[next_row][next_col] >= 0:
+                    continue
+                cell = self.field[next_row][next_col]
+                if cell == '.':
+                    self.route[next_row][next_col] = value
+                    queue.append((next_row, next_col))
+                elif cell == 's':
+                    # creeps leave spawns, but do not walk through them
+                    self.route[next_row][next_col] = value
+        for row, col in self.starts:
+            if self.route[row][col] < 0:
+                raise MapError('Bad map: can not build route from start at '
+                               'row %s, col %s to end.' % (row, col))
         self.build_optimal_route()
+        if self.digest is not None:
+            self.route_cache[self.digest] = (
+                self.starts, self.ends, self.route, self.creep_path,
+                self.path_next, self.path_indices, self.spawns)
 
     def find_next_cell(self, row, col):
         """ Find next cell in route from cell with given row and col. """
-        value = int(self.route[row][col])
-        if row > 0 and self.route[row-1][col] == value - 1:
-            return row-1, col
-        if row < len(self.route) - 1 and self.route[row+1][col] == value - 1:
-            return row+1, col
-        if col > 0 and self.route[row][col-1] == value - 1:
-            return row, col-1
-        if col < len(self.route[row]) - 1 and self.route[row][col+1] == value - 1:
-            return row, col+1
+        value = self.route[row][col]
+        if value > 0:
+            for next_row, next_col in self.neighbours(row, col):
+                if (self.route[next_row][next_col] == value - 1 and
+                        self.field[next_row][next_col] in ('.', 'e')):
+                    return next_row, next_col
         return row, col
 
+    def path_order(self, cell):
+        """ Sort key of cell in creep path: the furthest from exits first. """
+        return -self.route[cell[0]][cell[1]], cell
+
     def build_optimal_route(self):
-        """ Find the shortest route and remember it for creeps moving. """
-        self.creep_path = []
-        self.optimal_route = copy.deepcopy(self.field)
-        row, col = self.end_row, self.end_col
-        while True:
-            self.optimal_route[row][col] = self.route[row][col]
-            self.creep_path.append((row, col))
-            if row == self.start_row and col == self.start_col:
-                break
-            row, col = self.find_next_cell(row, col)
-        self.creep_path = self.creep_path[::-1]
+        """ Number cells of routes from all spawns and link them together. """
+        cells = set()
+        for cell in self.starts:
+            while cell not in cells:
+                cells.add(cell)
+                cell = self.find_next_cell(*cell)
+        self.creep_path = sorted(cells, key=self.path_order)
+        self.link_route()
+
+    def link_route(self):
+        """ Find index and next cell of every cell in creep path. """
+        self.path_indices = {cell: index for index, cell in enumerate(self.creep_path)}
+        self.path_next = [self.path_indices[self.find_next_cell(*cell)]
+                          for cell in self.creep_path]
+        self.spawns = [self.path_indices[cell] for cell in self.starts]
+
+    def open_maze(self):
+        """ Let towers block path cells.
+
+        Creep path is extended to every cell creeps can walk from, so
+        creeps turned away from their route by new towers always stand on
+        creep path. Route shared through route_cache is copied first.
+        """
+        self.route = [array.array('i', line) for line in self.route]
+        self.blocked = set()
+        self.creep_path = sorted(
+            ((row, col) for row in range(len(self.field))
+             for col in range(len(self.field[row])) if self.route[row][col] >= 0),
+            key=self.path_order)
+        self.link_route()
+
+    def is_supported(self, row, col):
+        """ Check if cell still has neighbour one step closer to exit. """
+        value = self.route[row][col] - 1
+        for next_row, next_col in self.neighbours(row, col):
+            if (self.route[next_row][next_col] == value and
+                    self.field[next_row][next_col] in ('.', 'e')):
+                return True
+        return False
+
+    def block(self, row, col, occupied=()):
+        """ Block path cell with tower and repair flow field around it.
+
+        Cells which had the shortest way out only through blocked cell are
+        found level by level from it, then get new distances from their
+        intact neighbours. Only this region is visited. Return dict of
+        changed cells with their old distances, or None, changing nothing,
+        if a spawn or one of occupied cells would be cut off from exits.
+        """
+        changed = {(row, col): self.route[row][col]}
+        self.route[row][col] = -1
+        self.blocked.add((row, col))
+        lost = []
+        queue = collections.deque([(row, col)] if changed[(row, col)] >= 0 else [])
+        while queue:
+            cell_row, cell_col = queue.popleft()
+            value = changed[(cell_row, cell_col)] + 1
+            for next_row, next_col in self.neighbours(cell_row, cell_col):
+                if (self.route[next_row][next_col] == value and
+                        not self.is_supported(next_row, next_col)):
+                    changed[(next_row, next_col)] = value
+                    self.route[next_row][next_col] = -1
+                    lost.append((next_row, next_col))
+                    if self.field[next_row][next_col] == '.':
+                        queue.append((next_row, next_col))
+
+        heap = []
+        for cell_row, cell_col in lost:
+            for next_row, next_col in self.neighbours(cell_row, cell_col):
+                value = self.route[next_row][next_col]
+                if value >= 0 and self.field[next_row][next_col] in ('.', 'e'):
+                    heap.append((value + 1, cell_row, cell_col))
+        heapq.heapify(heap)
+        while heap:
+            value, cell_row, cell_col = heapq.heappop(heap)
+            if self.route[cell_row][cell_col] >= 0:
+                continue
+            self.route[cell_row][cell_col] = value
+            if self.field[cell_row][cell_col] != '.':
+                continue
+            for next_row, next_col in self.neighbours(cell_row, cell_col):
+                if (self.route[next_row][next_col] < 0 and
+                        (next_row, next_col) in changed and
+                        (next_row, next_col) not in self.blocked):
+                    heapq.heappush(heap, (value + 1, next_row, next_col))
+
+        for cell_row, cell_col in itertools.chain(self.starts, occupied):
+            if self.route[cell_row][cell_col] < 0:
+                for (cell_row, cell_col), value in changed.items():
+                    self.route[cell_row][cell_col] = value
+                self.blocked.discard((row, col))
+                return None
+        return changed
+
+    def unblock(self, row, col):
+        """ Open blocked path cell and spread shorter distances from it.
+
+        Return dict of changed cells with their old distances.
+        """
+        self.blocked.discard((row, col))
+        changed = {(row, col): -1}
+        for next_row, next_col in self.neighbours(row, col):
+            value = self.route[next_row][next_col]
+            if value >= 0 and self.field[next_row][next_col] in ('.', 'e'):
+                if self.route[row][col] < 0 or value + 1 < self.route[row][col]:
+                    self.route[row][col] = value + 1
+        queue = collections.deque([(row, col)] if self.route[row][col] >= 0 else [])
+        while queue:
+            cell_row, cell_col = queue.popleft()
+            value = self.route[cell_row][cell_col] + 1
+            for next_row, next_col in self.neighbours(cell_row, cell_col):
+                old_value = self.route[next_row][next_col]
+                if ((old_value < 0 or old_value > value) and
+                        self.field[next_row][next_col] in ('.', 's') and
+                        (next_row, next_col) not in self.blocked):
+                    changed.setdefault((next_row, next_col), old_value)
+                    self.route[next_row][next_col] = value
+                    if self.field[next_row][next_col] == '.':
+                        queue.append((next_row, next_col))
+        return changed
+
+    def reindex(self, changed):
+        """ Renumber creep path after distances of changed cells changed.
+
+        Order of other cells stays the same, so changed cells are merged
+        into it in one pass instead of sorting the whole path.
+        """
+        kept = [cell for cell in self.creep_path if cell not in changed]
+        moved = sorted((cell for cell in changed if self.route[cell[0]][cell[1]] >= 0),
+                       key=self.path_order)
+        self.creep_path = list(heapq.merge(kept, moved, key=self.path_order))
+        self.link_route()
+
+
+class MapCache():
+
+    """ Class designed to save map with its routes in compact binary form.
+
+    File starts with header: magic, SHA1 digest, size and modification
+    time of source text, field size and sizes of lists below. Then go
+    field cells, one byte each, and int32 arrays: flow field, creep path
+    as (row, col) pairs, path_next, spawn and exit cells, spawn indices.
+    Sections are aligned to 4 bytes, so file is memory mapped and arrays
+    are copied out of it as they are, without parsing. Mapping is closed
+    right after, so cached maps do not keep files open.
+    """
+
+    MAGIC = b'TDMAP01\n'
+    HEADER = struct.Struct('=8s20sQqIIIII')
+    # offset of source size and modification time in header
+    STAMP_OFFSET = 28
+
+    @staticmethod
+    def filename(map_name):
+        return os.path.splitext(map_name)[0] + COMPILED_MAP_EXT
+
+    @staticmethod
+    def align(size):
+        return (size + 3) & ~3
+
+    @classmethod
+    def write(cls, gf, filename, stat):
+        """ Save loaded map gf, stat is os.stat() of its source text. """
+        rows, cols = len(gf.field), len(gf.field[0])
+        ints = array.array('i')
+        for line in gf.route:
+            ints.extend(line)
+        for cell in gf.creep_path:
+            ints.extend(cell)
+        ints.extend(gf.path_next)
+        for cell in gf.starts + gf.ends:
+            ints.extend(cell)
+        ints.extend(gf.spawns)
+        grid = ''.join(gf.field).encode()
+        header = cls.HEADER.pack(
+            cls.MAGIC, bytes.fromhex(gf.digest), stat.st_size, stat.st_mtime_ns,
+            rows, cols, len(gf.creep_path), len(gf.starts), len(gf.ends))
+        temp_name = '%s.%s.tmp' % (filename, os.getpid())
+        try:
+            with open(temp_name, 'wb') as f:
+                f.write(header)
+                f.write(grid.ljust(cls.align(len(grid)), b'\0'))
+                f.write(ints.tobytes())
+            os.replace(temp_name, filename)
+        except OSError:
+            # cache is optional, map directory may be read-only
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
+
+    @classmethod
+    def stamp(cls, filename, stat):
+        """ Rewrite size and modification time of source text in header. """
+        try:
+            with open(filename, 'r+b') as f:
+                f.seek(cls.STAMP_OFFSET)
+                f.write(struct.pack('=Qq', stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            pass
+
+    @classmethod
+    def read(cls, gf, filename, stat, digest=None):
+        """ Load compiled map into gf if it was compiled from source text.
+
+        Source is identified by its digest if given, by its size and
+        modification time otherwise. Return False if file is missing, out
+        of date or damaged.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        with data:
+            return cls.read_data(gf, data, filename, stat, digest)
+
+    @classmethod
+    def read_data(cls, gf, data, filename, stat, digest):
+        """ Load compiled map from mapped file data, see read(). """
+        if len(data) < cls.HEADER.size:
+            return False
+        (magic, raw_digest, size, mtime_ns, rows, cols, path_length, n_starts,
+         n_ends) = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            return False
+        if digest is not None:
+            if raw_digest.hex() != digest:
+                return False
+        elif (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return False
+        n_ints = (rows * cols + 3 * path_length + 2 * (n_starts + n_ends) +
+                  n_starts)
+        if (not rows or not cols or not n_starts or not n_ends or
+                len(data) != cls.HEADER.size + cls.align(rows * cols) + 4 * n_ints):
+            return False
+        offset = cls.HEADER.size
+        try:
+            grid = data[offset:offset + rows * cols].decode()
+        except UnicodeDecodeError:
+            return False
+        offset += cls.align(rows * cols)
+        # slices of array are copies, so nothing refers to mapping later
+        ints = array.array('i')
+        ints.frombytes(data[offset:])
+        field = [grid[row * cols:(row + 1) * cols] for row in range(rows)]
+        route = [ints[row * cols:(row + 1) * cols] for row in range(rows)]
+        position = rows * cols
+        flat = ints[position:position + 2 * path_length].tolist()
+        creep_path = list(zip(flat[0::2], flat[1::2]))
+        position += 2 * path_length
+        path_next = ints[position:position + path_length]
+        position += path_length
+        flat = ints[position:position + 2 * (n_starts + n_ends)].tolist()
+        cells = list(zip(flat[0::2], flat[1::2]))
+        position += 2 * (n_starts + n_ends)
+        spawns = ints[position:position + n_starts].tolist()
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            # source was touched but not changed, next load need not hash it
+            cls.stamp(filename, stat)
+        gf.field = field
+        gf.digest = raw_digest.hex()
+        gf.starts, gf.ends = cells[:n_starts], cells[n_starts:]
+        gf.route = route
+        gf.creep_path = creep_path
+        gf.path_next = path_next
+        gf.path_indices = {cell: index for index, cell in enumerate(creep_path)}
+        gf.spawns = spawns
+        GameField.route_cache[gf.digest] = (
+            gf.starts, gf.ends, gf.route, gf.creep_path, gf.path_next,
+            gf.path_indices, gf.spawns)
+        return True
+
 
 class Cursor():
 
@@ -220,16 +625,69 @@ class Cursor():
         if self.col < self.max_cols -1:
             self.col += 1
 
-    def draw(self, stdscr):
-        stdscr.addstr(self.row, self.col * CELL_WIDTH, '(')
-        stdscr.addstr(self.row, (self.col+1) * CELL_WIDTH-1, ')')
+
+class Viewport():
+
+    """ Visible part of game field, scrolled to keep cursor in sight.
+
+    Field cells (row, col) are drawn at screen row row - top and screen
+    column (col - left) * CELL_WIDTH.
+    """
+
+    def __init__(self, field_rows, field_cols, rows=MAX_ROWS, cols=MAX_COLS):
+        self.field_rows = field_rows
+        self.field_cols = field_cols
+        self.rows = min(rows, field_rows)
+        self.cols = min(cols, field_cols)
+        self.top = 0
+        self.left = 0
+
+    @staticmethod
+    def scroll(start, position, size, total):
+        """ New start of visible range of size so position is inside it. """
+        margin = min(SCROLL_MARGIN, (size - 1) // 2)
+        if position < start + margin:
+            start = position - margin
+        elif position >= start + size - margin:
+            start = position - size + margin + 1
+        return max(0, min(start, total - size))
+
+    def follow(self, cursor):
+        """ Scroll to cursor, return True if visible part of field changed. """
+        top = self.scroll(self.top, cursor.row, self.rows, self.field_rows)
+        left = self.scroll(self.left, cursor.col, self.cols, self.field_cols)
+        if (top, left) == (self.top, self.left):
+            return False
+        self.top, self.left = top, left
+        return True
+
+    def visible(self, row, col):
+        return (self.top <= row < self.top + self.rows and
+                self.left <= col < self.left + self.cols)
+
+    def cells(self):
+        """ Yield (row, col) of all visible cells. """
+        for row in range(self.top, self.top + self.rows):
+            for col in range(self.left, self.left + self.cols):
+                yield row, col
 
 
 class Creep():
 
     """ Class represents creep, which is moving from start to end point. """
 
-    def __init__(self, start_row, start_col, hp, reward, speed=1, boss=False):
+    __slots__ = ('row', 'col', 'hp', 'reward', 'boss', 'speed', 'original_speed',
+                 'move_points', 'image', 'path_index', 'effects')
+
+    image_set = CREEP_IMAGE
+
+    def __init__(self, start_row, start_col, hp, reward, speed=1, boss=False,
+                 path_index=0):
+        self.reset(start_row, start_col, hp, reward, speed, boss, path_index)
+
+    def reset(self, start_row, start_col, hp, reward, speed=1, boss=False,
+              path_index=0):
+        """ Make creep as new, so creeps which left the game can be reused. """
         self.row = start_row
         self.col = start_col
         self.hp = hp
@@ -238,13 +696,17 @@ class Creep():
         self.speed = speed
         self.original_speed = speed
         self.move_points = 0
-        self.image_set = CREEP_IMAGE
         self.image = 0
+        # index of current cell in creep path
+        self.path_index = path_index
+        # effect kind -> list of [value, expire tick], see StatusEffects
+        self.effects = {}
 
-    def move(self, next_row, next_col):
+    def move(self, next_index, next_row, next_col):
         if self.move_points >= MOVE_SPEED_POINTS:
             self.row = next_row
             self.col = next_col
+            self.path_index = next_index
             self.move_points = 0
             self.image = 0
         else:
@@ -256,10 +718,6 @@ class Creep():
         if self.image >= len(self.image_set):
             self.image = 0
 
-    def draw(self, stdscr):
-        stdscr.addstr(self.row, self.col * CELL_WIDTH, self.image_set[self.image],
-                      curses.color_pair(RED))
-
     def get_damage(self, damage):
         """ Receive damage from towers. """
         self.hp -= damage
@@ -267,31 +725,208 @@ class Creep():
         if self.hp < 0:
             self.hp == 0
 
-    def slow_effect(self, slow_points):
-        self.speed = self.original_speed - slow_points
-        if self.speed < 0.1:
-            self.speed = 0.1
+    def effect_value(self, kind):
+        """ Summary value of all active effects of given kind. """
+        return sum(record[0] for record in self.effects.get(kind, ()))
 
-    def clear_effects(self):
-        self.speed = self.original_speed
+    def update_effects(self):
+        """ Recalculate stats after effects were applied or expired. """
+        slow = self.effect_value('slow')
+        if slow:
+            self.speed = max(self.original_speed - slow, 0.1)
+        else:
+            self.speed = self.original_speed
+
+
+class StatusEffects():
+
+    """ Timed effects of all creeps with expiry ticks in a priority queue.
+
+    Every effect record is [value, expire tick] kept in creep.effects, and
+    queue holds one (expire tick, order, creep, kind, record) entry per
+    record, so every tick only effects which are due are touched. Record
+    whose duration was restarted is pushed back when its old entry comes
+    out; entries of records which are gone (replaced, or creep was reset
+    for reuse) are just dropped.
+    """
+
+    def __init__(self, effects=EFFECTS):
+        self.rules = effects
+        self.queue = []
+        # makes order of entries with the same expire tick stable
+        self.pushed = 0
+        self.now = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, creep, kind, record):
+        heapq.heappush(self.queue, (record[1], self.pushed, creep, kind, record))
+        self.pushed += 1
+
+    def apply(self, creep, kind, value):
+        """ Put effect on creep following stacking rule of its kind. """
+        rule = self.rules[kind]
+        expire = self.now + rule['duration']
+        records = creep.effects.setdefault(kind, [])
+        if rule['stacking'] == 'stack' or not records:
+            record = [value, expire]
+            records.append(record)
+            self.push(creep, kind, record)
+        else:
+            record = records[0]
+            if rule['stacking'] == 'strongest' and value < record[0]:
+                return
+            record[0] = value
+            record[1] = expire
+        creep.update_effects()
+
+    def expire(self, now):
+        """ Remove effects which end at tick now. """
+        self.now = now
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            _, _, creep, kind, record = heapq.heappop(queue)
+            records = creep.effects.get(kind, ())
+            if not any(item is record for item in records):
+                continue
+            if record[1] > now:
+                self.push(creep, kind, record)
+                continue
+            records[:] = [item for item in records if item is not record]
+            if not records:
+                del creep.effects[kind]
+            creep.update_effects()
+
+    def restore(self, creep):
+        """ Queue effects of creep restored from snapshot. """
+        for kind, records in creep.effects.items():
+            for record in records:
+                self.push(creep, kind, record)
+
+
+class CreepIndex():
+
+    """ Spatial index of creeps by their position in creep path.
+
+    Creeps can stand only on creep path cells, so each tower's area of damage
+    is stored once as runs of path indices and creeps are bucketed by path
+    index once per tick. Finding targets is then a range query over sorted
+    occupied indices.
+    """
+
+    def __init__(self, creep_path, path_cells=None):
+        self.creep_path = creep_path
+        # (row, col) -> index in creep path
+        if path_cells is None:
+            path_cells = {cell: index for index, cell in enumerate(creep_path)}
+        self.path_cells = path_cells
+        self.buckets = {}
+        self.occupied = []
+        self.coverage = {}
+
+    def update(self, creeps):
+        """ Rebuild buckets from current creeps positions. """
+        self.buckets = {}
+        for creep in creeps:
+            bucket = self.buckets.get(creep.path_index)
+            if bucket is None:
+                self.buckets[creep.path_index] = [creep]
+            else:
+                bucket.append(creep)
+        self.occupied = sorted(self.buckets)
+
+    def add_tower(self, tower):
+        """ Compute (or refresh) runs of path indices in tower's range.
+
+        Runs are (first, last) pairs, furthest along the path first. Cells
+        of tower's area or the whole path are scanned, whichever is smaller,
+        so building on huge maps does not cost a pass over long path.
+        """
+        side = 2 * tower.range + 1
+        if side * side < len(self.creep_path):
+            indices = sorted(
+                self.path_cells[(row, col)]
+                for row in range(tower.row - tower.range, tower.row + tower.range + 1)
+                for col in range(tower.col - tower.range, tower.col + tower.range + 1)
+                if (row, col) in self.path_cells)
+        else:
+            indices = [index for index, (row, col) in enumerate(self.creep_path)
+                       if abs(row - tower.row) <= tower.range and
+                       abs(col - tower.col) <= tower.range]
+        runs = []
+        for index in indices:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        self.coverage[tower] = [tuple(run) for run in reversed(runs)]
+
+    def remove_tower(self, tower):
+        self.coverage.pop(tower, None)
+
+    def occupied_in_range(self, tower):
+        """ Yield occupied path indices in tower's range, in descending order. """
+        for first, last in self.coverage[tower]:
+            position = bisect.bisect_right(self.occupied, last) - 1
+            while position >= 0 and self.occupied[position] >= first:
+                yield self.occupied[position]
+                position -= 1
+
+    def in_range(self, tower):
+        """ Yield creeps in tower's area of damage. """
+        for index in self.occupied_in_range(tower):
+            yield from self.buckets[index]
+
+    def furthest(self, tower):
+        """ Find creep in tower's range which is furthest along the path.
+
+        Among creeps on the same cell the one closest to its next move wins,
+        ties go to the creep spawned first.
+        """
+        occupied = self.occupied
+        for first, last in self.coverage[tower]:
+            # same as the first index of occupied_in_range, without generator
+            position = bisect.bisect_right(occupied, last) - 1
+            if position >= 0 and occupied[position] >= first:
+                bucket = self.buckets[occupied[position]]
+                target = bucket[0]
+                for creep in bucket:
+                    if creep.move_points > target.move_points:
+                        target = creep
+                return target
+        return None
 
 
 class Tower():
 
-    """ Class represents tower which can be built by player to destroy creeps. """
+    """ Class represents tower which can be built by player to destroy creeps.
+
+    Data shared by all towers of the same type (images, base stats, price)
+    are class attributes of subclasses, instances keep only what changes.
+    """
+
+    __slots__ = ('rng', 'range', 'damage', 'speed', 'image', 'target', 'row',
+                 'col', 'speed_points', 'price', 'level')
 
-    def __init__(self, tower_type, row, col):
-        self.tower_type = tower_type
-        self.range = TOWERS[tower_type]['range']
-        self.damage = TOWERS[tower_type]['damage']
-        self.speed = TOWERS[tower_type]['speed']
-        self.image_set = TOWERS[tower_type]['images']
+    tower_type = None
+    stats = {}
+    upgrade_stats = {}
+    image_set = ()
+    base_price = 0
+
+    def __init__(self, row, col, rng=None):
+        # random numbers generator owned by game, random module by default
+        self.rng = rng or random
+        self.range = self.stats['range']
+        self.damage = self.stats['damage']
+        self.speed = self.stats['speed']
         self.image = 0
         self.target = None
         self.row = row
         self.col = col
         self.speed_points = FPS
-        self.price = PRICES[tower_type]
+        self.price = self.base_price
         self.level = 1
 
     def _next_image(self):
@@ -300,18 +935,13 @@ class Tower():
         if self.image >= len(self.image_set):
             self.image = 0
 
-    def find_target(self, creeps):
-        """ Find first creep in tower's area of damage. """
-        self.target = None
-        for creep in creeps:
-            if (abs(creep.row - self.row) <= self.range and
-                abs(creep.col - self.col) <= self.range):
-                self.target = creep
-                break
-
-    def attack(self, creeps):
-        """ Attack creep if it is possible. """
-        self.find_target(creeps)
+    def find_target(self, creep_index):
+        """ Find creep furthest along the path in tower's area of damage. """
+        self.target = creep_index.furthest(self)
+
+    def attack(self, creep_index, effects):
+        """ Attack creep if it is possible, effects is StatusEffects. """
+        self.find_target(creep_index)
         if self.target:
             while self.speed_points >= ATTACK_SPEED_POINTS:
                 self.target.get_damage(self.damage)
@@ -324,18 +954,14 @@ class Tower():
 
     def upgrade(self):
         """ Upgrade tower stats. """
-        if 'damage' in UPGRADE_STATS[self.tower_type]:
-            self.damage += UPGRADE_STATS[self.tower_type]['damage'] * self.level
-        if 'speed' in UPGRADE_STATS[self.tower_type]:
-            self.speed += UPGRADE_STATS[self.tower_type]['speed'] * self.level
-        self.range += UPGRADE_STATS[self.tower_type].get('range', 0)
-        self.price += self.level * PRICES[self.tower_type] * TOWER_UPGRADE_PRICE_MULTIPLIER
+        if 'damage' in self.upgrade_stats:
+            self.damage += self.upgrade_stats['damage'] * self.level
+        if 'speed' in self.upgrade_stats:
+            self.speed += self.upgrade_stats['speed'] * self.level
+        self.range += self.upgrade_stats.get('range', 0)
+        self.price += self.level * self.base_price * TOWER_UPGRADE_PRICE_MULTIPLIER
         self.level += 1
 
-    def draw(self, stdscr):
-        stdscr.addstr(self.row, self.col * CELL_WIDTH,
-                      self.image_set[self.image], curses.color_pair(GREEN))
-
     def get_special(self):
         return 'no specials'
 
@@ -343,15 +969,19 @@ class Tower():
 class TowerChainsaw(Tower):
     """ Chainsaw tower damage multiple creeps at once. """
 
-    def find_target(self, creeps):
-        self.target = []
-        for creep in creeps:
-            if (abs(creep.row - self.row) <= self.range and
-                abs(creep.col - self.col) <= self.range):
-                self.target.append(creep)
+    __slots__ = ()
+
+    tower_type = 'c'
+    stats = TOWERS['c']
+    upgrade_stats = UPGRADE_STATS['c']
+    image_set = TOWERS['c']['images']
+    base_price = PRICES['c']
+
+    def find_target(self, creep_index):
+        self.target = list(creep_index.in_range(self))
 
-    def attack(self, creeps):
-        self.find_target(creeps)
+    def attack(self, creep_index, effects):
+        self.find_target(creep_index)
         if self.target:
             while self.speed_points >= ATTACK_SPEED_POINTS:
                 for target in self.target:
@@ -370,22 +1000,36 @@ class TowerChainsaw(Tower):
 class TowerMinigun(Tower):
     """ Minigun tower. No specials. """
 
-    pass
+    __slots__ = ()
+
+    tower_type = 'm'
+    stats = TOWERS['m']
+    upgrade_stats = UPGRADE_STATS['m']
+    image_set = TOWERS['m']['images']
+    base_price = PRICES['m']
 
 
 class TowerSniper(Tower):
     """ Sniper tower. Have chance for critical shot. """
 
-    def __init__(self, tower_type, row, col):
-        super().__init__(tower_type, row, col)
-        self.crit_chance = TOWERS[self.tower_type]['special']
+    __slots__ = ('crit_chance',)
+
+    tower_type = 's'
+    stats = TOWERS['s']
+    upgrade_stats = UPGRADE_STATS['s']
+    image_set = TOWERS['s']['images']
+    base_price = PRICES['s']
 
-    def attack(self, creeps):
-        """ Attack creep if it is possible. """
-        self.find_target(creeps)
+    def __init__(self, row, col, rng=None):
+        super().__init__(row, col, rng)
+        self.crit_chance = self.stats['special']
+
+    def attack(self, creep_index, effects):
+        """ Attack creep if it is possible, effects is StatusEffects. """
+        self.find_target(creep_index)
         if self.target:
             while self.speed_points >= ATTACK_SPEED_POINTS:
-                chance = random.randint(0, 100)
+                chance = self.rng.randint(0, 100)
                 damage = (self.damage * CRIT_MULTIPLIER
                           if chance <= self.crit_chance else self.damage)
                 self.target.get_damage(damage)
@@ -398,7 +1042,7 @@ class TowerSniper(Tower):
 
     def upgrade(self):
         super().upgrade()
-        self.crit_chance += UPGRADE_STATS[self.tower_type]['special']
+        self.crit_chance += self.upgrade_stats['special']
 
     def get_special(self):
         return '%sx crit, %s%% chance' % (CRIT_MULTIPLIER, self.crit_chance)
@@ -407,28 +1051,32 @@ class TowerSniper(Tower):
 class TowerIce(Tower):
     """ Ice tower. Slow multiple creeps. """
 
-    def __init__(self, tower_type, row, col):
-        super().__init__(tower_type, row, col)
-        self.slow_points = TOWERS[self.tower_type]['special']
+    __slots__ = ('slow_points',)
+
+    tower_type = 'i'
+    stats = TOWERS['i']
+    upgrade_stats = UPGRADE_STATS['i']
+    image_set = TOWERS['i']['images']
+    base_price = PRICES['i']
+
+    def __init__(self, row, col, rng=None):
+        super().__init__(row, col, rng)
+        self.slow_points = self.stats['special']
 
     def upgrade(self):
         super().upgrade()
-        self.slow_points += UPGRADE_STATS[self.tower_type]['special']
+        self.slow_points += self.upgrade_stats['special']
 
-    def find_target(self, creeps):
-        self.target = []
-        for creep in creeps:
-            if (abs(creep.row - self.row) <= self.range and
-                abs(creep.col - self.col) <= self.range):
-                self.target.append(creep)
+    def find_target(self, creep_index):
+        self.target = list(creep_index.in_range(self))
 
-    def attack(self, creeps):
-        self.find_target(creeps)
+    def attack(self, creep_index, effects):
+        self.find_target(creep_index)
         if self.target:
             while self.speed_points >= ATTACK_SPEED_POINTS:
                 for target in self.target:
                     target.get_damage(self.damage)
-                    target.slow_effect(self.slow_points)
+                    effects.apply(target, 'slow', self.slow_points)
                 self.speed_points -= ATTACK_SPEED_POINTS
             else:
                 self.speed_points += self.speed
@@ -441,306 +1089,1323 @@ class TowerIce(Tower):
 
 
 class TowerFactory():
-    def __new__(self, tower_type, row, col):
+    def __new__(self, tower_type, row, col, rng=None):
         if tower_type == 'c':
-            return TowerChainsaw(tower_type, row, col)
+            return TowerChainsaw(row, col, rng)
         elif tower_type == 'm':
-            return TowerMinigun(tower_type, row, col)
+            return TowerMinigun(row, col, rng)
         elif tower_type == 's':
-            return TowerSniper(tower_type, row, col)
+            return TowerSniper(row, col, rng)
         elif tower_type == 'i':
-            return TowerIce(tower_type, row, col)
+            return TowerIce(row, col, rng)
         else:
             raise ValueError
 
 
-class GameController():
-
-    """ Class designed to control game flow, get user input, move creeps, etc. """
-
-    def __init__(self, stdscr):
-        self.stdscr = stdscr
-        self.cursor = None
+class WaveScript():
+
+    """ Waves of creeps of a map, made from wave definition.
+
+    Definition is a dict (JSON file next to map) with keys:
+      rounds - number of rounds, null to play until lifes run out;
+      hp, reward, speed - curves of creep stats: 'start' is value in the
+        first round, every next round which grows adds 'add' and
+        'add_per_round' times number of previous rounds to it;
+      waves - list of waves, every round plays the first one which matches
+        it by 'every' (every n-th round), 'from' and 'to' (round numbers),
+        the last wave has no conditions and matches the rest. Wave with
+        'grow': false does not advance stat curves. Its 'groups' of creeps
+        come out one after another, group has 'count' of creeps, which
+        come 'spacing' ticks one after another ('delay' ticks after the
+        previous group), and multipliers 'hp', 'reward' and 'speed' of
+        stats; creeps of group with 'boss' take BOSS_LIFES.
+
+    Definition is checked once, then schedule() lazily makes waves round
+    by round, each as list of (ticks after previous creep, creep template)
+    where template is (hp, reward, speed, boss).
+    """
+
+    CURVES = ('hp', 'reward', 'speed')
+    WAVE_KEYS = {'every', 'from', 'to', 'grow', 'groups'}
+    GROUP_KEYS = {'count', 'spacing', 'delay', 'boss', 'hp', 'reward', 'speed'}
+
+    def __init__(self, script=DEFAULT_WAVES):
+        self.rounds = script.get('rounds')
+        if self.rounds is not None and not self.is_count(self.rounds, 1):
+            raise MapError('Wave script: rounds must be positive number or null.')
+        self.curves = {}
+        for name in self.CURVES:
+            curve = script.get(name)
+            if not isinstance(curve, dict) or not self.is_number(curve.get('start')):
+                raise MapError('Wave script: %s curve needs start value.' % (name,))
+            self.curves[name] = (curve['start'], curve.get('add', 0),
+                                 curve.get('add_per_round', 0))
+            if not all(self.is_number(value) for value in self.curves[name]):
+                raise MapError('Wave script: %s curve values must be numbers.' % (name,))
+        self.waves = script.get('waves')
+        if not isinstance(self.waves, list) or not self.waves:
+            raise MapError('Wave script: waves list is empty.')
+        for n, wave in enumerate(self.waves, 1):
+            self.check_wave(n, wave)
+        if self.WAVE_KEYS.intersection(self.waves[-1]) - {'grow', 'groups'}:
+            raise MapError('Wave script: the last wave must match every round.')
+
+    @staticmethod
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    @staticmethod
+    def is_count(value, minimum=0):
+        return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+    def check_wave(self, n, wave):
+        if not isinstance(wave, dict) or set(wave) - self.WAVE_KEYS:
+            raise MapError('Wave script: wave %s has unknown keys.' % (n,))
+        for key in ('every', 'from', 'to'):
+            if key in wave and not self.is_count(wave[key], 1):
+                raise MapError('Wave script: %s of wave %s must be positive number.'
+                               % (key, n))
+        groups = wave.get('groups')
+        if not isinstance(groups, list):
+            raise MapError('Wave script: wave %s has no groups list.' % (n,))
+        for group in groups:
+            if not isinstance(group, dict) or set(group) - self.GROUP_KEYS:
+                raise MapError('Wave script: group of wave %s has unknown keys.' % (n,))
+            if not self.is_count(group.get('count')):
+                raise MapError('Wave script: group of wave %s needs count.' % (n,))
+            for key in ('spacing', 'delay'):
+                if key in group and not self.is_count(group[key], 1):
+                    raise MapError('Wave script: %s in wave %s must be positive '
+                                   'number of ticks.' % (key, n))
+            for key in self.CURVES:
+                if key in group and not self.is_number(group[key]):
+                    raise MapError('Wave script: %s in wave %s must be number.'
+                                   % (key, n))
+
+    @staticmethod
+    def filename(map_name):
+        return os.path.splitext(map_name)[0] + WAVES_EXT
+
+    @classmethod
+    def load(cls, map_name):
+        """ Wave script of map, default waves if map has none. """
+        filename = cls.filename(map_name)
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename) as f:
+            try:
+                script = json.load(f)
+            except ValueError as error:
+                raise MapError('Wave script %s is not valid JSON: %s'
+                               % (filename, error))
+        if not isinstance(script, dict):
+            raise MapError('Wave script %s is not JSON object.' % (filename,))
+        return cls(script)
+
+    def wave(self, round_number):
+        """ Wave definition played in given round. """
+        for wave in self.waves:
+            if (round_number % wave.get('every', 1) == 0
+                    and wave.get('from', 1) <= round_number
+                    and round_number <= wave.get('to', round_number)):
+                return wave
+
+    def schedule(self, difficulty_hp=0):
+        """ Yield spawn list of every round, computed only when asked. """
+        stats = {name: curve[0] for name, curve in self.curves.items()}
+        round_number = 1
+        while self.rounds is None or round_number <= self.rounds:
+            wave = self.wave(round_number)
+            if round_number > 1 and wave.get('grow', True):
+                for name, (_, add, add_per_round) in self.curves.items():
+                    stats[name] += add + add_per_round * (round_number - 1)
+            spawns = []
+            for group in wave['groups']:
+                hp = int(stats['hp'] * group.get('hp', 1))
+                # modify creep hp according to difficulty
+                hp += int(hp * difficulty_hp)
+                template = (hp, int(stats['reward'] * group.get('reward', 1)),
+                            stats['speed'] * group.get('speed', 1),
+                            group.get('boss', False))
+                spacing = group.get('spacing', 1)
+                if group['count']:
+                    spawns.append((group.get('delay', spacing), template))
+                    spawns.extend([(spacing, template)] * (group['count'] - 1))
+            yield spawns
+            round_number += 1
+
+
+class GameEngine():
+
+    """ Class designed to simulate game: waves, creeps, towers and economy.
+
+    Engine knows nothing about terminal. Every call of tick() advances game
+    by one time tick, so game runs as fast as CPU allows when driven by
+    step() directly, or at FPS rate when driven by GameController.
+
+    All randomness comes from engine's own generator seeded with seed, so
+    the same seed and the same player's actions at the same ticks give
+    exactly the same game.
+    """
+
+    # game attributes saved in snapshots
+    STATE_FIELDS = ('lifes', 'gold', 'kills', 'creep_hp', 'level_round',
+                    'creep_count', 'ticks', 'second_ticks', 'sec', 'spawn_on',
+                    'next_round', 'send_wave_finish', 'sent_creeps',
+                    'next_spawn_tick', 'last_round', 'game_over')
+    TOWER_FIELDS = ('level', 'damage', 'speed', 'range', 'speed_points', 'image',
+                    'price', 'crit_chance', 'slow_points')
+    CREEP_FIELDS = ('path_index', 'hp', 'reward', 'speed', 'original_speed',
+                    'move_points', 'boss', 'image', 'effects')
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        # Replay which records player's actions, if any
+        self.replay = None
+        # PerfStats which times game phases, if any
+        self.stats = None
+
+    def setup_level(self, level, difficulty, maze=False):
+        """ Load appropriate map, nullify all stats. """
+        self.setup_map(MAP_FILE % (level,), difficulty, maze)
 
-    def draw_field(self):
-        """ Draw game field. """
-        for row in range(self.field_rows):
-            for col in range(self.field_cols):
-                cell = self.field[row][col]
-                self.stdscr.addstr(row, col * CELL_WIDTH,
-                                   FIELD_IMAGE[cell],
-                                   curses.color_pair(FIELD_COLOR[cell]))
+    def setup_map(self, map_name, difficulty, maze=False):
+        """ Load map from given file, nullify all stats.
 
-    def setup_level(self, level, difficulty):
-        """ Load appropriate map, nullify all stats. """
-        map_name = 'map%s.txt' % (level,)
+        In maze mode towers may be built on path cells too, creeps walk
+        around them.
+        """
         gf = GameField()
         gf.load(map_name)
+        self.setup_field(gf, map_name, difficulty, maze)
+
+    def setup_field(self, gf, map_name, difficulty, maze=False, waves=None):
+        """ Start game on GameField, which may be made in memory.
+
+        map_name is only remembered for snapshots and replays, which can
+        be restored only if map is saved to that file. waves is WaveScript,
+        by default the one saved next to map_name.
+        """
         gf.build_route()
-        self.start_row = gf.start_row
-        self.start_col = gf.start_col
+        if maze:
+            gf.open_maze()
+        self.game_field = gf
+        self.map_name = map_name
+        self.difficulty = difficulty
+        self.maze = maze
+        if self.seed is None:
+            self.seed = random.randrange(2 ** 32)
+        self.rng = random.Random(self.seed)
         self.creep_path = gf.creep_path
+        self.path_next = gf.path_next
+        self.spawns = gf.spawns
         self.creeps = []
+        # creeps which left the game, reused by spawn_creep
+        self.creep_pool = []
+        # path index -> number of creeps on that cell, cells without creeps
+        # are left out
+        self.creep_counts = {}
+        self.creep_index = CreepIndex(self.creep_path, gf.path_indices)
+        self.effects = StatusEffects()
         self.field = gf.field
-        self.route = gf.optimal_route
+        self.route = gf.route
         self.field_rows = len(self.field)
         self.field_cols = len(self.field[0])
-        self.cursor = Cursor(0, 0, self.field_rows, self.field_cols)
         self.lifes = LIFES
+        # towers in order they were built, they attack in this order
         self.towers = []
+        # (row, col) -> tower built there
+        self.tower_cells = {}
         self.gold = START_GOLD
         self.kills = 0
-        # Save original creep hp to make correct calculations
-        self.base_creep_hp = START_CREEP_HP
+        self.waves = waves if waves is not None else WaveScript.load(map_name)
+        self.rounds = self.waves.rounds
         self.difficulty_hp = DIFFICULTY_HP_MULTIPLIER[difficulty]
+        self.schedule = self.waves.schedule(self.difficulty_hp)
+        # spawn list of current round and of the round after it, which is
+        # None after the last round
+        self.wave = []
+        self.next_wave = next(self.schedule, None)
         # used for initial creep info
-        self.creep_hp = START_CREEP_HP
-        self.creep_hp += int(self.creep_hp * self.difficulty_hp)
+        self.creep_hp = self.wave_hp(self.next_wave)
         self.level_round = 0
         self.creep_count = 0
-
-    def setup_round(self, round_number):
-        """ Prepare next wave of creeps. """
-        self.level_round = round_number + 1
-        self.boss_round = True if self.level_round % BOSS_ROUND == 0 else False
-
-        if self.level_round == 1:
-            self.creep_hp = START_CREEP_HP
-            self.temp_creep_hp = START_CREEP_HP
-            self.creep_reward = START_CREEP_REWARD
-            self.temp_creep_reward = START_CREEP_REWARD
-            self.creep_count = CREEP_COUNT
-            self.creep_speed = START_CREEP_SPEED
+        # wave timer
+        self.ticks = 0
+        self.second_ticks = 0
+        self.sec = TIME_BETWEEN_WAVES
+        self.spawn_on = False
+        self.next_round = False
+        self.send_wave_finish = True
+        self.sent_creeps = 0
+        self.next_spawn_tick = 0
+        self.last_round = False
+        self.game_over = False
+
+    @staticmethod
+    def wave_hp(wave):
+        return wave[0][1][0] if wave else 0
+
+    def setup_round(self):
+        """ Take next wave of creeps from schedule. """
+        self.level_round += 1
+        self.wave = self.next_wave
+        self.next_wave = next(self.schedule, None)
+        self.creep_count = len(self.wave)
+        self.creep_hp = self.wave_hp(self.wave)
+        self.sent_creeps = 0
+        if self.wave:
+            self.next_spawn_tick = self.ticks + self.wave[0][0]
+
+    def spawn_creep(self, spawn, template):
+        """ Spawn new creep at given spawn index.
+
+        template is (hp, reward, speed, boss) from wave schedule.
+        """
+        row, col = self.creep_path[spawn]
+        hp, reward, speed, boss = template
+        if self.creep_pool:
+            creep = self.creep_pool.pop()
+            creep.reset(row, col, hp, reward, speed=speed, boss=boss,
+                        path_index=spawn)
         else:
-            self.base_creep_hp = self.temp_creep_hp
-            self.creep_reward = self.temp_creep_reward
-            if self.boss_round:
-                self.creep_count = 1
-                self.temp_creep_hp = self.base_creep_hp
-                self.base_creep_hp *= BOSS_HP_MULTIPLY
-                self.creep_reward *= BOSS_REWARD_MULTIPLY
-            else:
-                self.creep_count = CREEP_COUNT
-                self.base_creep_hp += (self.level_round - 1) * CREEP_HP_LEVEL_MULTIPLIER
-                self.temp_creep_hp = self.base_creep_hp
-                self.creep_reward += CREEP_REWARD_UPGRADE
-                self.temp_creep_reward = self.creep_reward
-                self.creep_speed += CREEP_SPEED_UPGRADE
-        #modify creep hp according to difficulty
-        self.creep_hp = self.base_creep_hp + int(self.base_creep_hp * self.difficulty_hp)
-
-    def spawn_creep(self):
-        """ Spawn new creep with current level stats. """
-        self.creeps.append(Creep(self.start_row, self.start_col, self.creep_hp,
-                                 self.creep_reward, speed=self.creep_speed,
-                                 boss=self.boss_round))
-        if self.boss_round:
-            self.boss = self.creeps[0]
+            creep = Creep(row, col, hp, reward, speed=speed, boss=boss,
+                          path_index=spawn)
+        self.creeps.append(creep)
+        self.creep_counts[spawn] = self.creep_counts.get(spawn, 0) + 1
+
+    def leave_cell(self, path_index):
+        """ Count creep off cell with given path index. """
+        count = self.creep_counts[path_index] - 1
+        if count:
+            self.creep_counts[path_index] = count
         else:
-            self.boss = None
+            del self.creep_counts[path_index]
+
+    def count_creeps(self):
+        """ Count creeps on every cell from scratch, e.g. after restore. """
+        self.creep_counts = {}
+        for creep in self.creeps:
+            self.creep_counts[creep.path_index] = self.creep_counts.get(creep.path_index, 0) + 1
 
     def move_creeps(self):
         """ Move all creeps to next cell in route. """
         temp_creeps = []
-        for creep in self.creeps:
-            cell_index = self.creep_path.index((creep.row, creep.col))
-            if cell_index >= len(self.creep_path) - 1:
+        counts = self.creep_counts
+        for n, creep in enumerate(self.creeps):
+            path_index = creep.path_index
+            next_index = self.path_next[path_index]
+            if next_index == path_index:
                 if creep.boss:
                     self.lifes -= BOSS_LIFES
                 else:
                     self.lifes -= 1
+                self.creep_pool.append(creep)
+                self.leave_cell(path_index)
                 if self.lifes <= 0:
+                    # creeps after the one which took the last life stay
+                    # where they are
+                    self.creeps = temp_creeps + self.creeps[n + 1:]
                     raise ExitGame
             else:
                 temp_creeps.append(creep)
-                row, col = self.creep_path[cell_index + 1]
-                creep.move(row, col)
-                creep.draw(self.stdscr)
+                row, col = self.creep_path[next_index]
+                creep.move(next_index, row, col)
+                if creep.path_index != path_index:
+                    self.leave_cell(path_index)
+                    counts[next_index] = counts.get(next_index, 0) + 1
         self.creeps = temp_creeps
 
-    def is_free_place_for_tower(self, row=None, col=None):
-        """ Check if tower can be built in current cursor's place. """
-        if not row and not col:
-            row = self.cursor.row
-            col = self.cursor.col
+    def is_free_place_for_tower(self, row, col):
+        """ Check if tower can be built in cell with given row and col.
+
+        In maze mode tower on path cell may still be refused by build_tower
+        if it cuts creeps off from exits.
+        """
+        if (row, col) in self.tower_cells:
+            return False
+        return self.field[row][col] == 'w' or (self.maze and self.field[row][col] == '.')
+
+    def creep_cells(self):
+        """ Set of (row, col) of cells where creeps stand. """
+        return {self.creep_path[path_index] for path_index in self.creep_counts}
+
+    def block_path_cell(self, row, col):
+        """ Block path cell for tower in maze mode, return False if refused. """
+        occupied = self.creep_cells()
+        if (row, col) in occupied:
+            return False
+        changed = self.game_field.block(row, col, occupied)
+        if changed is None:
+            return False
+        self.reroute(changed)
+        return True
+
+    def reroute(self, changed):
+        """ Move creeps and towers coverage to creep path renumbered by maze. """
+        old_path = self.creep_path
+        gf = self.game_field
+        gf.reindex(changed)
+        self.creep_path = gf.creep_path
+        self.path_next = gf.path_next
+        self.spawns = gf.spawns
+        self.remap_creeps([gf.path_indices.get(cell, -1) for cell in old_path])
+        self.count_creeps()
+        self.creep_index = CreepIndex(self.creep_path, gf.path_indices)
         for tower in self.towers:
-            if tower.row == row and tower.col == col:
-                return False
-        return self.field[row][col] == 'w'
+            self.creep_index.add_tower(tower)
 
-    def build_tower(self, tower):
-        """ Build tower in current cursor's place. """
-        if self.is_free_place_for_tower():
+    def remap_creeps(self, new_indices):
+        """ Change creeps path indices, new_indices maps old index to new. """
+        for creep in self.creeps:
+            creep.path_index = new_indices[creep.path_index]
+
+    def find_tower(self, row, col):
+        """ Find tower in cell with given row and col. """
+        return self.tower_cells.get((row, col))
+
+    def add_tower(self, tower):
+        self.towers.append(tower)
+        self.tower_cells[(tower.row, tower.col)] = tower
+        self.creep_index.add_tower(tower)
+
+    def build_tower(self, tower, row, col):
+        """ Build tower of given type in cell with given row and col. """
+        if self.is_free_place_for_tower(row, col):
             if self.gold >= PRICES[tower]:
-                self.towers.append(TowerFactory(tower, self.cursor.row, self.cursor.col))
+                if self.field[row][col] == '.' and not self.block_path_cell(row, col):
+                    return
+                self.add_tower(TowerFactory(tower, row, col, self.rng))
                 self.gold -= PRICES[tower]
 
-    def destroy_tower(self):
-        """ Destroy tower in current cursor's place. """
-        new_tower_list = []
+    def destroy_tower(self, row, col):
+        """ Destroy tower in cell with given row and col. """
+        tower = self.tower_cells.pop((row, col), None)
+        if tower is None:
+            return
+        self.gold += tower.price * TOWER_DESTROY_PRICE_PERCENTAGE // 100
+        self.creep_index.remove_tower(tower)
+        self.towers.remove(tower)
+        if self.field[row][col] == '.':
+            self.reroute(self.game_field.unblock(row, col))
+
+    def upgrade_tower(self, row, col):
+        """ Upgrade tower in cell with given row and col. """
+        tower = self.tower_cells.get((row, col))
+        if tower is not None:
+            upgrade_price = tower.level * PRICES[tower.tower_type] * TOWER_UPGRADE_PRICE_MULTIPLIER
+            if self.gold >= upgrade_price and tower.level < TOWER_MAX_LEVEL:
+                tower.upgrade()
+                self.creep_index.add_tower(tower)
+                self.gold -= upgrade_price
+
+    def send_wave(self):
+        """ Send next wave of creeps without waiting for wave timer. """
+        self.next_round = True
+
+    def perform(self, action, *args):
+        """ Perform player's action and record it to replay.
+
+        Actions: ('build', tower_type, row, col), ('upgrade', row, col),
+        ('destroy', row, col), ('send_wave',) and ('pause',), which changes
+        nothing in simulation and is recorded only to show it on playback.
+        """
+        if self.replay is not None:
+            self.replay.record(self.ticks, action, *args)
+        if action == 'build':
+            self.build_tower(*args)
+        elif action == 'upgrade':
+            self.upgrade_tower(*args)
+        elif action == 'destroy':
+            self.destroy_tower(*args)
+        elif action == 'send_wave':
+            self.send_wave()
+
+    def snapshot(self):
+        """ Return whole game state as plain Python values. """
+        state = {'map_name': self.map_name, 'difficulty': self.difficulty,
+                 'maze': self.maze, 'seed': self.seed, 'rng': self.rng.getstate()}
+        for name in self.STATE_FIELDS:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        state['towers'] = {
+            (tower.row, tower.col): (tower.tower_type,) +
+            tuple(getattr(tower, name, None) for name in self.TOWER_FIELDS)
+            for tower in self.towers}
+        # towers attack in order they were built
+        state['tower_order'] = list(state['towers'])
+        state['creeps'] = [tuple(getattr(creep, name) for name in self.CREEP_FIELDS)
+                           for creep in self.creeps]
+        # effect records change in place, so snapshot keeps their copies
+        for n, values in enumerate(state['creeps']):
+            effects = {kind: [tuple(record) for record in records]
+                       for kind, records in values[-1].items()}
+            state['creeps'][n] = values[:-1] + (effects,)
+        return state
+
+    def restore(self, state):
+        """ Continue game from state returned by snapshot(). """
+        self.seed = state['seed']
+        self.setup_map(state['map_name'], state['difficulty'],
+                       state.get('maze', False))
+        self.rng.setstate(state['rng'])
+        for name in self.STATE_FIELDS:
+            if name in state:
+                setattr(self, name, state[name])
+        # schedule is made again up to current round
+        for _ in range(self.level_round):
+            self.wave = self.next_wave
+            self.next_wave = next(self.schedule, None)
+        changed = {}
+        for row, col in state['tower_order']:
+            if self.field[row][col] == '.':
+                for cell, value in self.game_field.block(row, col).items():
+                    changed.setdefault(cell, value)
+        if changed:
+            self.reroute(changed)
+        for row, col in state['tower_order']:
+            tower_type, *values = state['towers'][(row, col)]
+            tower = TowerFactory(tower_type, row, col, self.rng)
+            for name, value in zip(self.TOWER_FIELDS, values):
+                if value is not None:
+                    setattr(tower, name, value)
+            self.add_tower(tower)
+        self.restore_creeps(state['creeps'])
+        self.count_creeps()
+
+    def restore_creeps(self, creeps):
+        for values in creeps:
+            creep = Creep(0, 0, 0, 0)
+            for name, value in zip(self.CREEP_FIELDS, values):
+                setattr(creep, name, value)
+            creep.row, creep.col = self.creep_path[creep.path_index]
+            creep.effects = {kind: [list(record) for record in records]
+                             for kind, records in creep.effects.items()}
+            self.effects.restore(creep)
+            self.creeps.append(creep)
+
+    def state_digest(self):
+        """ Hash of whole simulation state, used to compare replays. """
+        state = [self.ticks, self.gold, self.lifes, self.kills, self.level_round,
+                 self.sec, self.sent_creeps]
+        state.extend((tower.tower_type, tower.row, tower.col, tower.level,
+                      tower.damage, tower.speed, tower.range, tower.speed_points)
+                     for tower in self.towers)
+        state.extend((creep.path_index, creep.hp, float(creep.move_points),
+                      float(creep.speed)) for creep in self.creeps)
+        return hashlib.sha1(repr(state).encode()).hexdigest()
+
+    def attack_creeps(self):
+        """ Let all towers find targets and attack them. """
+        if not self.creeps:
+            # nothing to search for, towers just stop animation
+            for tower in self.towers:
+                tower.target = None
+                tower.image = 0
+            return
+        self.creep_index.update(self.creeps)
         for tower in self.towers:
-            if tower.row == self.cursor.row and tower.col == self.cursor.col:
-                self.gold += tower.price * TOWER_DESTROY_PRICE_PERCENTAGE // 100
-            else:
-                new_tower_list.append(tower)
-        self.towers = new_tower_list
+            tower.attack(self.creep_index, self.effects)
 
-    def upgrade_tower(self):
-        """ Upgrade tower in current cursor's place. """
-        for tower in self.towers:
-            if tower.row == self.cursor.row and tower.col == self.cursor.col:
-                upgrade_price = tower.level * PRICES[tower.tower_type] * TOWER_UPGRADE_PRICE_MULTIPLIER
-                if self.gold >= upgrade_price and tower.level < TOWER_MAX_LEVEL:
-                    tower.upgrade()
-                    self.gold -= upgrade_price
-                break
-
-    def action_per_time_tick(self, creep_count):
-        """ Perform game actions per time tick. """
-        for tower in self.towers:
-            tower.attack(self.creeps)
-        # remove dead creeps
+    def remove_dead_creeps(self):
+        """ Remove killed creeps and pay reward for them. """
         alive_creeps = []
         for creep in self.creeps:
             if creep.hp <= 0:
                 self.kills += 1
                 self.gold += creep.reward
+                self.creep_pool.append(creep)
+                self.leave_cell(creep.path_index)
             else:
                 alive_creeps.append(creep)
         self.creeps = alive_creeps
-        self.move_creeps()
-
-    def show_object_under_cursor(self):
-        tower_info_template = 'Tower\n\nDamage: %s\nRange: %s\nSpeed: %s\n'\
-                              'Upgrade price: %s\nDestroy price: %s\n'\
-                              'Special: %s\nLevel: %s/%s'
-        for offset in range(len(tower_info_template.split('\n'))):
-            self.stdscr.addstr(OBJECT_INFO_ROW + offset, OBJECT_INFO_COL, ' ' * 30)
-            offset += 1
-        for tower in self.towers:
-            if tower.row == self.cursor.row and tower.col == self.cursor.col:
-                obj_info = tower_info_template \
-                           % (tower.damage, tower.range, tower.speed,
-                              tower.level  * PRICES[tower.tower_type] * TOWER_UPGRADE_PRICE_MULTIPLIER,
-                              tower.price * TOWER_DESTROY_PRICE_PERCENTAGE // 100,
-                              tower.get_special(), tower.level, TOWER_MAX_LEVEL)
-                offset = 0
-                for line in obj_info.split('\n'):
-                    self.stdscr.addstr(OBJECT_INFO_ROW + offset, OBJECT_INFO_COL, line)
-                    offset += 1
-
-    def is_start_free(self):
+
+    def run_phase(self, name, phase):
+        """ Run one phase of time tick, timing it if stats are collected. """
+        if self.stats is None:
+            phase()
+        else:
+            self.stats.measure(name, phase)
+
+    def action_per_time_tick(self):
+        """ Perform game actions per time tick. """
+        self.run_phase('effects', self.expire_effects)
+        self.run_phase('attack', self.attack_creeps)
+        self.run_phase('remove_dead', self.remove_dead_creeps)
+        self.run_phase('move', self.move_creeps)
+
+    def expire_effects(self):
+        """ Remove effects which end at this tick. """
+        self.effects.expire(self.ticks)
+
+    def is_start_free(self, spawn):
+        return spawn not in self.creep_counts
+
+    @property
+    def boss_hp(self):
         for creep in self.creeps:
-            if creep.row == self.start_row and creep.col == self.start_col:
-                return False
+            if creep.boss:
+                return creep.hp
+        return 0
+
+    def tick(self):
+        """ Advance game by one time tick. Raise ExitGame when game is over. """
+        if self.last_round and not self.creeps:
+            raise ExitGame
+
+        self.ticks += 1
+        self.action_per_time_tick()
+
+        if self.spawn_on:
+            self.run_phase('spawn', self.send_creeps)
+        if self.stats is not None:
+            self.stats.count('ticks')
+            self.stats.gauges['creeps'] = len(self.creeps)
+            self.stats.gauges['towers'] = len(self.towers)
+
+        self.second_ticks += 1
+        if self.second_ticks == FPS:
+            self.second_ticks = 0
+            self.sec -= 1
+
+        if ((self.sec <= 0 or self.next_round) and self.send_wave_finish
+                and not self.last_round):
+            self.setup_round()
+            self.sec = TIME_BETWEEN_WAVES
+            self.spawn_on = True
+            self.next_round = False
+            self.send_wave_finish = False
+
+    def send_creeps(self):
+        """ Spawn next creep of the wave when it is due and its start cell
+        is free.
+
+        Creeps of a wave come out of spawn cells in turn. Game ends when
+        wave of the last round is sent and all its creeps are gone.
+        """
+        if self.sent_creeps < self.creep_count:
+            if self.ticks >= self.next_spawn_tick:
+                spawn = self.spawns[self.sent_creeps % len(self.spawns)]
+                if self.is_start_free(spawn):
+                    self.spawn_creep(spawn, self.wave[self.sent_creeps][1])
+                    self.sent_creeps += 1
+                    if self.sent_creeps < self.creep_count:
+                        self.next_spawn_tick = (self.ticks +
+                                                self.wave[self.sent_creeps][0])
+        else:
+            self.spawn_on = False
+            self.sent_creeps = 0
+            self.send_wave_finish = True
+            if self.next_wave is None:
+                self.last_round = True
+
+    def idle_ticks(self):
+        """ Number of next ticks in which only wave timer changes.
+
+        Game is idle when no creeps are on the field and the next wave
+        waits for the timer.
+        """
+        if (self.creeps or not self.send_wave_finish or self.next_round
+                or self.last_round or self.game_over):
+            return 0
+        return max((self.sec - 1) * FPS + FPS - self.second_ticks - 1, 0)
+
+    def skip_idle(self):
+        """ Advance game over all idle ticks at once, return their number.
+
+        Result is the same as of calling tick() that many times, so headless
+        players use it to skip waiting for the next wave. Player's actions
+        still may be performed before, as gold does not change while idle.
+        """
+        n_ticks = self.idle_ticks()
+        if n_ticks:
+            self.ticks += n_ticks
+            self.expire_effects()
+            self.attack_creeps()
+            second_ticks = self.second_ticks + n_ticks
+            self.sec -= second_ticks // FPS
+            self.second_ticks = second_ticks % FPS
+            if self.stats is not None:
+                # not simulated one by one, so kept out of ticks rate
+                self.stats.count('skipped_ticks', n_ticks)
+        return n_ticks
+
+    def step(self, n_ticks=1):
+        """ Advance game by n_ticks time ticks as fast as possible.
+
+        Return False if game is over (all lifes lost or last round passed).
+        """
+        if not self.game_over:
+            try:
+                for _ in range(n_ticks):
+                    self.tick()
+            except ExitGame:
+                self.game_over = True
+        return not self.game_over
+
+
+def make_engine(backend='python', seed=None):
+    """ Create simulation engine, NumPy backend is imported only if asked. """
+    if backend == 'numpy':
+        from vector_engine import VectorEngine
+        return VectorEngine(seed)
+    return GameEngine(seed)
+
+
+class Replay():
+
+    """ Class designed to record player's actions and play them back.
+
+    Replay file starts with JSON header (map, difficulty, maze mode, seed,
+    last tick and state digest at the end of game) followed by one line per
+    action: tick, action and its arguments separated by spaces.
+    """
+
+    def __init__(self, map_name, difficulty, seed, maze=False):
+        self.map_name = map_name
+        self.difficulty = difficulty
+        self.seed = seed
+        self.maze = maze
+        self.actions = []
+        self.ticks = None
+        self.digest = None
+
+    def record(self, tick, action, *args):
+        self.actions.append((tick, action) + args)
+
+    def finish(self, engine):
+        """ Remember how recorded game ended. """
+        self.ticks = engine.ticks
+        self.digest = engine.state_digest()
+
+    def save(self, filename):
+        header = {'map': self.map_name, 'difficulty': self.difficulty,
+                  'maze': self.maze, 'seed': self.seed, 'ticks': self.ticks, 'digest': self.digest}
+        with open(filename, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+            for action in self.actions:
+                f.write(' '.join(str(value) for value in action) + '\n')
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            header = json.loads(f.readline())
+            replay = cls(header['map'], header['difficulty'], header['seed'],
+                         header.get('maze', False))
+            replay.ticks = header['ticks']
+            replay.digest = header['digest']
+            for line in f:
+                values = [int(value) if value.isdigit() else value
+                          for value in line.split()]
+                replay.actions.append(tuple(values))
+        return replay
+
+    def play(self, engine):
+        """ Re-simulate recorded game on engine as fast as possible.
+
+        Engine must be created with replay's seed. Return True if game ended
+        in exactly the same state as recorded one.
+        """
+        engine.setup_map(self.map_name, self.difficulty, self.maze)
+        for tick, action, *args in self.actions:
+            engine.step(tick - engine.ticks)
+            engine.perform(action, *args)
+        engine.step(self.ticks - engine.ticks)
+        return engine.state_digest() == self.digest
+
+
+class Checkpointer():
+
+    """ Class designed to save game checkpoints to file cheaply.
+
+    First checkpoint (and every full_every-th after it) is a full snapshot,
+    the rest store only values which differ from the last full snapshot.
+    Every record is kind byte (F - full, D - delta), 4 bytes of length and
+    zlib compressed JSON of state.
+    """
+
+    def __init__(self, filename, full_every=FULL_SNAPSHOT_EVERY):
+        self.filename = filename
+        self.full_every = full_every
+        self.base = None
+        self.deltas = 0
+
+    @staticmethod
+    def encode(state):
+        """ State with towers keyed by cell turned to JSON friendly lists. """
+        state = dict(state)
+        if 'towers' in state:
+            towers = state['towers']
+            if isinstance(towers, tuple):
+                changed, removed = towers
+                state['towers'] = [[list(cell) + list(tower)
+                                    for cell, tower in changed.items()], removed]
+            else:
+                state['towers'] = [list(cell) + list(tower)
+                                   for cell, tower in towers.items()]
+        return state
+
+    @staticmethod
+    def decode(state, kind):
+        """ Reverse encode() for record of given kind. """
+        if 'towers' in state:
+            if kind == b'F':
+                towers = state['towers']
+            else:
+                towers, removed = state['towers']
+            towers = {(row, col): tuple(tower) for row, col, *tower in towers}
+            if kind == b'F':
+                state['towers'] = towers
+            else:
+                state['towers'] = (towers, [tuple(cell) for cell in removed])
+        if 'tower_order' in state:
+            state['tower_order'] = [tuple(cell) for cell in state['tower_order']]
+        if 'rng' in state:
+            version, internal_state, gauss_next = state['rng']
+            state['rng'] = (version, tuple(internal_state), gauss_next)
+        return state
+
+    @classmethod
+    def write_record(cls, f, kind, payload):
+        data = zlib.compress(
+            json.dumps(cls.encode(payload), separators=(',', ':')).encode(), 1)
+        f.write(kind + struct.pack('>I', len(data)) + data)
+
+    @staticmethod
+    def delta(base, state):
+        """ Values of state which differ from base state. """
+        delta = {}
+        for name, value in state.items():
+            if name == 'towers':
+                base_towers = base['towers']
+                changed = {cell: tower for cell, tower in value.items()
+                           if base_towers.get(cell) != tower}
+                removed = [cell for cell in base_towers if cell not in value]
+                if changed or removed:
+                    delta['towers'] = (changed, removed)
+            elif base.get(name) != value:
+                delta[name] = value
+        return delta
+
+    @staticmethod
+    def apply_delta(base, delta):
+        state = dict(base)
+        for name, value in delta.items():
+            if name == 'towers':
+                changed, removed = value
+                towers = dict(base['towers'])
+                towers.update(changed)
+                for cell in removed:
+                    del towers[cell]
+                state['towers'] = towers
+            else:
+                state[name] = value
+        return state
+
+    def save(self, engine):
+        state = engine.snapshot()
+        if self.base is None or self.deltas >= self.full_every:
+            # previous checkpoints stay on disk until new file is complete
+            temp_name = '%s.%s.tmp' % (self.filename, os.getpid())
+            with open(temp_name, 'wb') as f:
+                self.write_record(f, b'F', state)
+            os.replace(temp_name, self.filename)
+            self.base = state
+            self.deltas = 0
+        else:
+            with open(self.filename, 'ab') as f:
+                self.write_record(f, b'D', self.delta(self.base, state))
+            self.deltas += 1
+
+    @classmethod
+    def load(cls, filename):
+        """ Return game state of the last checkpoint in file.
+
+        Reading stops at the first incomplete or broken record, e.g. the
+        one being written when game crashed.
+        """
+        base = delta = None
+        with open(filename, 'rb') as f:
+            while True:
+                header = f.read(5)
+                if len(header) < 5:
+                    break
+                kind = header[:1]
+                (length,) = struct.unpack('>I', header[1:])
+                data = f.read(length)
+                if kind not in (b'F', b'D') or len(data) < length:
+                    break
+                try:
+                    payload = cls.decode(json.loads(zlib.decompress(data)), kind)
+                except (zlib.error, ValueError, TypeError):
+                    break
+                if kind == b'F':
+                    base, delta = payload, None
+                else:
+                    delta = payload
+        if base is None:
+            raise ValueError('No game snapshot in %s' % (filename,))
+        return cls.apply_delta(base, delta) if delta else base
+
+
+class PerfStats():
+
+    """ Class designed to time game phases and count drawing calls.
+
+    Totals are kept for the whole game and can be dumped to JSON file.
+    Averages over the last full second are shown in performance overlay.
+    """
+
+    PHASES = ('effects', 'attack', 'remove_dead', 'move', 'spawn', 'draw',
+              'refresh')
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.start = clock()
+        # phase -> seconds spent and number of runs since start
+        self.totals = collections.Counter()
+        self.runs = collections.Counter()
+        # event (ticks, frames, addstr) -> count since start
+        self.counters = collections.Counter()
+        # current values like number of creeps alive
+        self.gauges = {}
+        self.window_start = self.start
+        self.window_totals = collections.Counter()
+        self.window_runs = collections.Counter()
+        self.window_counters = collections.Counter()
+        # results of the last finished window
+        self.phase_us = {}
+        self.rates = {}
+
+    def measure(self, name, function, *args):
+        """ Call function, adding time it took to phase name. """
+        start = self.clock()
+        try:
+            return function(*args)
+        finally:
+            spent = self.clock() - start
+            self.totals[name] += spent
+            self.runs[name] += 1
+            self.window_totals[name] += spent
+            self.window_runs[name] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+        self.window_counters[name] += value
+
+    def roll_window(self):
+        """ Finish averaging window if it lasts a second, return True if so. """
+        now = self.clock()
+        seconds = now - self.window_start
+        if seconds < 1:
+            return False
+        self.phase_us = {name: self.window_totals[name] / runs * 1e6
+                         for name, runs in self.window_runs.items()}
+        self.rates = {name: count / seconds
+                      for name, count in self.window_counters.items()}
+        self.window_start = now
+        self.window_totals.clear()
+        self.window_runs.clear()
+        self.window_counters.clear()
         return True
 
-    def main_loop(self):
-        tick = 0
-        sec = TIME_BETWEEN_WAVES
-        timer = time.time()
-        creep_count = 0
-        spawn_on = False
-        next_round = False
-        send_wave_finish = True
-        sent_creeps = 0
-        last_round = False
-        self.boss = None
-        while True:
-            if not self.pause:
-                self.draw_field()
-                for tower in self.towers:
-                    tower.draw(self.stdscr)
+    def overlay_lines(self):
+        lines = ['Performance, us per run']
+        for name in self.PHASES:
+            lines.append('%-12s %9.1f' % (name, self.phase_us.get(name, 0)))
+        frames = self.rates.get('frames', 0)
+        lines.append('Ticks/sec: %d  Frames/sec: %d'
+                     % (self.rates.get('ticks', 0), frames))
+        lines.append('addstr/frame: %.1f'
+                     % (self.rates.get('addstr', 0) / frames if frames else 0))
+        lines.append('Creeps: %s  Towers: %s'
+                     % (self.gauges.get('creeps', 0), self.gauges.get('towers', 0)))
+        return lines
 
-                new_time = time.time()
-                if last_round and creep_count == 0:
-                    raise ExitGame
+    def dump(self, filename):
+        """ Save totals since start to JSON file. """
+        phases = {name: {'runs': self.runs[name],
+                         'total_sec': round(self.totals[name], 6),
+                         'mean_us': round(self.totals[name] / self.runs[name] * 1e6, 2)}
+                  for name in self.runs}
+        with open(filename, 'w') as f:
+            json.dump({'seconds': round(self.clock() - self.start, 3),
+                       'phases': phases, 'counters': dict(self.counters),
+                       'gauges': self.gauges}, f, indent=1)
 
-                if (new_time - timer) >= (1 / FPS):
-                    timer = new_time
-                    tick += 1
-                    self.action_per_time_tick(creep_count)
-                    creep_count = len(self.creeps)
-
-                    if spawn_on:
-                        if sent_creeps < self.creep_count:
-                            if self.is_start_free():
-                                self.spawn_creep()
-                                sent_creeps += 1
-                        else:
-                            spawn_on = False
-                            sent_creeps = 0
-                            send_wave_finish = True
-
-                self.stdscr.addstr(CREEP_ROW, 0, ' ' * 100)
-                self.stdscr.addstr(CREEP_ROW, 0, CREEP_INFO % (sec,
-                                                               self.creep_hp,
-                                                               sent_creeps,
-                                                               self.creep_count))
-
-                if tick == FPS:
-                    for creep in self.creeps:
-                        creep.clear_effects()
-                    tick = 0
-                    sec -= 1
-
-                if (sec == 0 or next_round) and send_wave_finish:
-                    if  self.level_round < MAX_ROUNDS:
-                        self.setup_round(self.level_round)
-                    else:
-                        last_round = True
-                    sec = TIME_BETWEEN_WAVES
-                    spawn_on = True
-                    next_round = False
-                    send_wave_finish = False
-
-                boss_hp = 0
-                for creep in self.creeps:
-                    creep.draw(self.stdscr)
-                    if creep.boss:
-                        boss_hp = creep.hp
-
-                self.cursor.draw(self.stdscr)
-                self.stdscr.addstr(HELP_INFO_ROW, 0, HELP_INFO)
-                status = STATUS_LINE % (self.gold, self.level_round, MAX_ROUNDS,
-                                        boss_hp, self.lifes, self.kills)
-                self.stdscr.addstr(STATUS_LINE_ROW, 0, ' ' * 100)
-                self.stdscr.addstr(STATUS_LINE_ROW, 0, status)
-                self.show_object_under_cursor()
-                self.stdscr.refresh()
 
-            c = self.stdscr.getch()
-            if c in (ord('q'), ord('Q')):
-                raise ExitGame
+class NullRenderer():
 
-            if c in (ord('p'), ord('P')):
-                self.pause = not self.pause
+    """ Renderer which draws nothing, used to run game without terminal. """
 
-            if not self.pause:
-                if c == ord(' '):
-                    next_round = True
+    stats = None
+    perf_overlay = False
+
+    def draw(self, engine, cursor):
+        pass
+
+
+class CursesRenderer():
+
+    """ Class designed to draw game state on curses screen.
+
+    Renderer remembers what is already on screen and rewrites only cells
+    and text lines which changed since previous frame: creeps moves, towers
+    animation, cursor moves, status text. Only part of field visible in
+    viewport is drawn, so frame cost does not depend on map size.
+    """
+
+    TOWER_INFO = 'Tower\n\nDamage: %s\nRange: %s\nSpeed: %s\n'\
+                 'Upgrade price: %s\nDestroy price: %s\n'\
+                 'Special: %s\nLevel: %s/%s'
+    TOWER_INFO_WIDTH = 30
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        # PerfStats to time drawing and count addstr calls, if any
+        self.stats = None
+        self.perf_overlay = False
+        self.invalidate()
+
+    def invalidate(self):
+        """ Forget screen content, next frame will be drawn from scratch. """
+        self.field = None
+        self.viewport = None
+        # (row, col) -> (image, color, cursor) of cells drawn over field
+        self.cells = {}
+        self.overlay = {}
+        self.cursor_cell = None
+        # screen row -> text
+        self.lines = {}
+        self.object_info = []
+        self.perf_info = []
+
+    def color(self, color):
+        return curses.color_pair(color)
+
+    def addstr(self, *args):
+        if self.stats is not None:
+            self.stats.count('addstr')
+        self.stdscr.addstr(*args)
+
+    def draw_cell(self, row, col, image, color, cursor):
+        row -= self.viewport.top
+        col -= self.viewport.left
+        self.addstr(row, col * CELL_WIDTH, image, self.color(color))
+        if cursor:
+            self.addstr(row, col * CELL_WIDTH, '(')
+            self.addstr(row, (col+1) * CELL_WIDTH-1, ')')
+
+    def draw_field(self, engine):
+        """ Draw visible part of game field. """
+        self.cells = {}
+        self.overlay = {}
+        self.cursor_cell = None
+        for row, col in self.viewport.cells():
+            cell = engine.field[row][col]
+            self.draw_cell(row, col, FIELD_IMAGE[cell], FIELD_COLOR[cell], False)
+
+    def draw_line(self, row, text):
+        """ Draw text line if it differs from one already on screen. """
+        old_text = self.lines.get(row)
+        if text == old_text:
+            return False
+        self.lines[row] = text
+        # pad with spaces to wipe the rest of longer old text
+        self.addstr(row, 0, text.ljust(len(old_text or '')))
+        return True
+
+    def draw_cells(self, engine, cursor):
+        """ Redraw cells where creeps, towers or cursor appeared or left. """
+        overlay = {}
+        visible = self.viewport.visible
+        if len(engine.towers) > self.viewport.rows * self.viewport.cols:
+            # look up visible cells instead of going through all towers
+            tower_cells = engine.tower_cells
+            towers = [tower_cells[cell] for cell in self.viewport.cells()
+                      if cell in tower_cells]
+        else:
+            towers = engine.towers
+        for tower in towers:
+            if visible(tower.row, tower.col):
+                overlay[(tower.row, tower.col)] = (tower.image_set[tower.image], GREEN)
+        for creep in engine.creeps:
+            if visible(creep.row, creep.col):
+                overlay[(creep.row, creep.col)] = (creep.image_set[creep.image], RED)
+        cursor_cell = (cursor.row, cursor.col)
+
+        dirty = set(self.overlay)
+        dirty.update(overlay)
+        dirty.add(cursor_cell)
+        if self.cursor_cell:
+            dirty.add(self.cursor_cell)
+        changed = False
+        for row, col in dirty:
+            if (row, col) in overlay:
+                image, color = overlay[(row, col)]
+            else:
+                cell = engine.field[row][col]
+                image, color = FIELD_IMAGE[cell], FIELD_COLOR[cell]
+            state = (image, color, (row, col) == cursor_cell)
+            if self.cells.get((row, col)) != state:
+                self.cells[(row, col)] = state
+                self.draw_cell(row, col, *state)
+                changed = True
+        self.overlay = overlay
+        self.cursor_cell = cursor_cell
+        return changed
+
+    def show_object_under_cursor(self, engine, cursor):
+        """ Show info about tower under cursor if it changed. """
+        tower = engine.find_tower(cursor.row, cursor.col)
+        if tower:
+            obj_info = self.TOWER_INFO \
+                       % (tower.damage, tower.range, tower.speed,
+                          tower.level  * PRICES[tower.tower_type] * TOWER_UPGRADE_PRICE_MULTIPLIER,
+                          tower.price * TOWER_DESTROY_PRICE_PERCENTAGE // 100,
+                          tower.get_special(), tower.level, TOWER_MAX_LEVEL)
+            lines = obj_info.split('\n')
+        else:
+            lines = []
+        if lines == self.object_info:
+            return False
+        for offset in range(max(len(lines), len(self.object_info))):
+            line = lines[offset] if offset < len(lines) else ''
+            self.addstr(OBJECT_INFO_ROW + offset, OBJECT_INFO_COL,
+                        line.ljust(self.TOWER_INFO_WIDTH))
+        self.object_info = lines
+        return True
 
-                if c in (curses.KEY_UP, ord('k'), ord('K')):
-                    self.cursor.move_up()
-                if c in (curses.KEY_DOWN, ord('j'), ord('J')):
-                    self.cursor.move_down()
-                if c in (curses.KEY_LEFT, ord('h'), ord('H')):
-                    self.cursor.move_left()
-                if c in (curses.KEY_RIGHT, ord('l'), ord('L')):
-                    self.cursor.move_right()
+    def show_perf_overlay(self):
+        """ Show performance stats once a second, wipe them when hidden. """
+        if self.perf_overlay and self.stats is not None:
+            if not self.stats.roll_window() and self.perf_info:
+                return False
+            lines = self.stats.overlay_lines()
+        else:
+            lines = []
+        if lines == self.perf_info:
+            return False
+        for offset in range(max(len(lines), len(self.perf_info))):
+            line = lines[offset] if offset < len(lines) else ''
+            self.addstr(PERF_INFO_ROW + offset, OBJECT_INFO_COL,
+                        line.ljust(self.TOWER_INFO_WIDTH))
+        self.perf_info = lines
+        return True
+
+    def draw(self, engine, cursor):
+        """ Draw changes of game screen since previous frame. """
+        if self.stats is None:
+            changed = self.draw_changes(engine, cursor)
+            if changed:
+                self.stdscr.refresh()
+        else:
+            self.stats.count('frames')
+            changed = self.stats.measure('draw', self.draw_changes, engine, cursor)
+            if changed:
+                self.stats.measure('refresh', self.stdscr.refresh)
+
+    def draw_changes(self, engine, cursor):
+        """ Draw what changed since previous frame, return True if anything. """
+        changed = False
+        if engine.field is not self.field:
+            self.field = engine.field
+            self.viewport = Viewport(engine.field_rows, engine.field_cols)
+            self.viewport.follow(cursor)
+            self.draw_field(engine)
+            self.addstr(HELP_INFO_ROW, 0, HELP_INFO)
+            changed = True
+        elif self.viewport.follow(cursor):
+            self.draw_field(engine)
+            changed = True
+        changed |= self.draw_cells(engine, cursor)
+        changed |= self.draw_line(CREEP_ROW, CREEP_INFO % (engine.sec,
+                                                           engine.creep_hp,
+                                                           engine.sent_creeps,
+                                                           engine.creep_count))
+        status = STATUS_LINE % (engine.gold, engine.level_round,
+                                engine.rounds or 'endless',
+                                engine.boss_hp, engine.lifes, engine.kills)
+        changed |= self.draw_line(STATUS_LINE_ROW, status)
+        changed |= self.show_object_under_cursor(engine, cursor)
+        changed |= self.show_perf_overlay()
+        return changed
 
-                if c in (ord('c'), ord('C'), ord('m'), ord('M'),
-                         ord('s'), ord('S'), ord('i'), ord('I')):
-                    self.build_tower(chr(c).lower())
 
-                if c in (ord('d'), ord('D')):
-                    self.destroy_tower()
+class GameController():
+
+    """ Class designed to control game flow, get user input and show game. """
+
+    def __init__(self, stdscr, renderer=None, record=None, seed=None,
+                 autosave=None, perf_log=None, maze=False):
+        self.stdscr = stdscr
+        self.renderer = renderer or CursesRenderer(stdscr)
+        self.engine = GameEngine(seed)
+        # let towers be built on path cells
+        self.maze = maze
+        # performance stats are collected from start if they go to file,
+        # otherwise only since performance overlay is first shown
+        self.perf_log = perf_log
+        self.stats = None
+        if perf_log:
+            self.collect_stats()
+        # file to save replay of the game to
+        self.record = record
+        # checkpoints are saved every AUTOSAVE_SECONDS if file is given
+        self.checkpointer = Checkpointer(autosave) if autosave else None
+        self.last_autosave = 0
+        self.cursor = None
+        self.pause = False
+        # set while game is not paused, used by asyncio run mode
+        self.unpaused = None
+
+    def setup_level(self, level, difficulty):
+        """ Load appropriate map, nullify all stats. """
+        self.setup_map(MAP_FILE % (level,), difficulty)
+
+    def setup_map(self, map_name, difficulty):
+        """ Load map from given file, nullify all stats. """
+        self.engine.setup_map(map_name, difficulty, self.maze)
+        if self.record:
+            self.engine.replay = Replay(self.engine.map_name, difficulty,
+                                        self.engine.seed, self.maze)
+        self.cursor = Cursor(0, 0, self.engine.field_rows, self.engine.field_cols)
+
+    def load_game(self, filename, maps=()):
+        """ Continue game from the last checkpoint saved to file.
+
+        Save may be for built-in map or one of maps, other map files are
+        not opened. Raise SaveError if game can not be loaded.
+        """
+        try:
+            state = Checkpointer.load(filename)
+            known_maps = [MAP_FILE % (level,) for level in range(1, 6)] + list(maps)
+            if state['map_name'] not in known_maps:
+                raise SaveError('Can not load save %s: map %r is not known, '
+                                'add it with --map.' % (filename, state['map_name']))
+            self.engine.restore(state)
+        except (OSError, LookupError, TypeError, AttributeError, ValueError,
+                MapError) as e:
+            raise SaveError('Can not load save %s: %s' % (filename, e))
+        self.cursor = Cursor(0, 0, self.engine.field_rows, self.engine.field_cols)
+        self.last_autosave = self.engine.ticks
+
+    def autosave(self):
+        if (self.checkpointer and
+                self.engine.ticks - self.last_autosave >= AUTOSAVE_SECONDS * FPS):
+            self.checkpointer.save(self.engine)
+            self.last_autosave = self.engine.ticks
+
+    def build_tower(self, tower, row=None, col=None):
+        """ Build tower in given cell, in current cursor's place by default. """
+        if row is None:
+            row, col = self.cursor.row, self.cursor.col
+        self.engine.perform('build', tower, row, col)
+
+    def destroy_tower(self, row=None, col=None):
+        """ Destroy tower in given cell, in current cursor's place by default. """
+        if row is None:
+            row, col = self.cursor.row, self.cursor.col
+        self.engine.perform('destroy', row, col)
+
+    def upgrade_tower(self, row=None, col=None):
+        """ Upgrade tower in given cell, in current cursor's place by default. """
+        if row is None:
+            row, col = self.cursor.row, self.cursor.col
+        self.engine.perform('upgrade', row, col)
+
+    def run_due_ticks(self):
+        """ Run all ticks which are due by now with fixed timestep.
+
+        Missed ticks are caught up (so game speed does not depend on load),
+        but no more than MAX_CATCH_UP_TICKS at once.
+        """
+        now = time.monotonic()
+        ticks = 0
+        while now >= self.next_tick and ticks < MAX_CATCH_UP_TICKS:
+            self.engine.tick()
+            self.next_tick += 1 / FPS
+            ticks += 1
+        self.autosave()
+        if now >= self.next_tick:
+            # too far behind, drop the rest instead of spiralling
+            self.next_tick = now
 
-                if c in (ord('u'), ord('U')):
-                    self.upgrade_tower()
+    def main_loop(self):
+        self.next_tick = time.monotonic()
+        while True:
+            if not self.pause:
+                self.run_due_ticks()
+                self.renderer.draw(self.engine, self.cursor)
+                # sleep in getch until key is pressed or next tick is due
+                wait = math.ceil((self.next_tick - time.monotonic()) * 1000)
+                self.stdscr.timeout(max(wait, 0))
+            else:
+                self.stdscr.timeout(-1)
+
+            self.handle_key(self.stdscr.getch())
+
+    def collect_stats(self):
+        self.stats = PerfStats()
+        self.engine.stats = self.stats
+        self.renderer.stats = self.stats
+
+    def toggle_overlay(self):
+        if self.stats is None:
+            self.collect_stats()
+        self.renderer.perf_overlay = not self.renderer.perf_overlay
+
+    def save_perf_log(self):
+        if self.perf_log and self.stats is not None:
+            self.stats.dump(self.perf_log)
+
+    def toggle_pause(self):
+        self.engine.perform('pause')
+        self.pause = not self.pause
+        # do not catch up ticks missed while paused
+        self.next_tick = time.monotonic()
+        if self.unpaused is not None:
+            if self.pause:
+                self.unpaused.clear()
+            else:
+                self.unpaused.set()
+
+    def handle_key(self, c):
+        """ Perform command bound to pressed key. """
+        if c in KEY_COMMANDS:
+            self.execute(*KEY_COMMANDS[c])
+
+    def execute(self, command, *args):
+        """ Perform player's command, like ('build', 'c') or ('move', 'up').
+
+        Tower commands may end with row and col of the cell, as network
+        players have their own cursors.
+        """
+        if command == 'quit':
+            raise ExitGame
+        if command == 'pause':
+            self.toggle_pause()
+        if command == 'overlay':
+            self.toggle_overlay()
+        if self.pause:
+            return
+        if command == 'send_wave':
+            self.engine.perform('send_wave')
+        elif command == 'move':
+            getattr(self.cursor, 'move_' + args[0])()
+        elif command == 'build':
+            self.build_tower(*args)
+        elif command == 'destroy':
+            self.destroy_tower(*args)
+        elif command == 'upgrade':
+            self.upgrade_tower(*args)
+
+    def save_replay(self):
+        if self.engine.replay is not None:
+            self.engine.replay.finish(self.engine)
+            self.engine.replay.save(self.record)
 
     def start_game(self):
-        self.stdscr.nodelay(True)
         self.stdscr.clear()
 
         self.pause = False
@@ -748,18 +2413,110 @@ class GameController():
             self.main_loop()
         except ExitGame:
             pass
+        finally:
+            self.stdscr.timeout(-1)
+            self.save_replay()
+            self.save_perf_log()
+
+    async def read_keys(self, commands):
+        """ Put commands bound to pressed keys into commands queue. """
+        loop = asyncio.get_running_loop()
+        key_pressed = asyncio.Event()
+        loop.add_reader(sys.stdin.fileno(), key_pressed.set)
+        try:
+            while True:
+                await key_pressed.wait()
+                key_pressed.clear()
+                c = self.stdscr.getch()
+                while c != -1:
+                    if c in KEY_COMMANDS:
+                        await commands.put(KEY_COMMANDS[c])
+                    c = self.stdscr.getch()
+        finally:
+            loop.remove_reader(sys.stdin.fileno())
+
+    async def execute_commands(self, commands):
+        """ Perform commands from all input sources. """
+        while True:
+            command = await commands.get()
+            self.execute(*command)
+
+    async def simulate(self):
+        """ Run game ticks at steady FPS rate. """
+        while True:
+            if self.pause:
+                await self.unpaused.wait()
+            self.run_due_ticks()
+            await asyncio.sleep(max(self.next_tick - time.monotonic(), 0))
+
+    async def render(self, render_fps):
+        """ Redraw screen render_fps times per second. """
+        while True:
+            if self.pause:
+                await self.unpaused.wait()
+            self.renderer.draw(self.engine, self.cursor)
+            await asyncio.sleep(1 / render_fps)
+
+    async def run_async(self, render_fps=FPS, input_sources=(), keyboard=True):
+        """ Run input, simulation and rendering as separate asyncio tasks.
+
+        Every input source is a coroutine function which receives commands
+        queue and puts there commands in form accepted by execute().
+        Without keyboard game runs with no terminal, e.g. as network server.
+        """
+        self.unpaused = asyncio.Event()
+        if not self.pause:
+            self.unpaused.set()
+        self.next_tick = time.monotonic()
+        commands = asyncio.Queue()
+        coroutines = [self.execute_commands(commands), self.simulate(),
+                      self.render(render_fps)]
+        if keyboard:
+            coroutines.append(self.read_keys(commands))
+        coroutines.extend(source(commands) for source in input_sources)
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def start_game_async(self, render_fps=FPS):
+        self.stdscr.clear()
+        self.stdscr.nodelay(True)
+
+        self.pause = False
+        try:
+            asyncio.run(self.run_async(render_fps))
+        except ExitGame:
+            pass
+        finally:
+            self.stdscr.nodelay(False)
+            self.save_replay()
+            self.save_perf_log()
 
 
 class MainMenu():
 
     """ Class responsible for Main Menu which appears on start. """
 
-    def __init__(self, stdscr):
+    def __init__(self, stdscr, render_fps=None, record=None, seed=None,
+                 autosave=None, perf_log=None, maps=(), maze=False):
         self.stdscr = stdscr
+        # redraw rate for asyncio run mode, None to use plain main loop
+        self.render_fps = render_fps
+        self.record = record
+        self.seed = seed
+        self.autosave = autosave
+        self.perf_log = perf_log
+        self.maze = maze
         self.top_row = 10
         self.left_col = 20
         self.cursor_row = 0
-        self.maps = [1, 2, 3, 4, 5]
+        self.maps = [MAP_FILE % (level,) for level in range(1, 6)]
+        self.maps.extend(maps)
         self.difficulties = ['easy', 'medium', 'hard']
         self.selected_map = 0
         self.selected_difficulty = 0
@@ -770,7 +2527,7 @@ class MainMenu():
 
     @property
     def text_map(self):
-        return self.text_map_template % (self.maps[self.selected_map],)
+        return self.text_map_template % (os.path.basename(self.maps[self.selected_map]),)
 
     @property
     def text_difficulty(self):
@@ -821,12 +2578,20 @@ class MainMenu():
             if self.selected_difficulty > len(self.difficulties) - 1:
                 self.selected_difficulty = 0
 
+    def play(self, game):
+        if self.render_fps:
+            game.start_game_async(self.render_fps)
+        else:
+            game.start_game()
+
     def enter_menu(self):
         if self.cursor_row == 2:
-            game = GameController(self.stdscr)
-            game.setup_level(self.selected_map + 1,
-                             self.difficulties[self.selected_difficulty])
-            game.start_game()
+            game = GameController(self.stdscr, record=self.record, seed=self.seed,
+                                  autosave=self.autosave, perf_log=self.perf_log,
+                                  maze=self.maze)
+            game.setup_map(self.maps[self.selected_map],
+                           self.difficulties[self.selected_difficulty])
+            self.play(game)
         if self.cursor_row == 3:
             sys.exit(0)
 
@@ -850,7 +2615,8 @@ class MainMenu():
                 self.enter_menu()
 
 
-def main(stdscr):
+def init_screen():
+    """ Hide cursor and set up colors of game screen. """
     # hide cursor by setting visibility to 0
     curses.curs_set(0)
     curses.start_color()
@@ -859,11 +2625,49 @@ def main(stdscr):
     curses.init_pair(GREEN, curses.COLOR_GREEN, curses.COLOR_BLACK)
     curses.init_pair(BLUE, curses.COLOR_BLUE, curses.COLOR_BLACK)
     curses.init_pair(YELLOW, curses.COLOR_YELLOW, curses.COLOR_BLACK)
-    menu = MainMenu(stdscr)
+
+
+def main(stdscr, args):
+    init_screen()
+    menu = MainMenu(stdscr, args.render_fps, args.record, args.seed,
+                    args.autosave, args.perf_log, args.map, args.maze)
+    if args.load:
+        game = GameController(stdscr, autosave=args.autosave,
+                              perf_log=args.perf_log)
+        game.load_game(args.load, args.map)
+        menu.play(game)
     menu.main_loop()
 
 
 if __name__ == '__main__':
-    curses.wrapper(main)
+    parser = argparse.ArgumentParser(description='Tower Defence game in your terminal.')
+    parser.add_argument('--map', action='append', default=[], metavar='FILE',
+                        help='add map FILE to maps in menu, maps bigger than '
+                             '%sx%s cells are scrolled with cursor'
+                             % (MAX_ROWS, MAX_COLS))
+    parser.add_argument('--maze', action='store_true',
+                        help='allow towers on path cells, creeps walk around '
+                             'them')
+    parser.add_argument('--render-fps', type=int, default=None,
+                        help='run input, simulation and rendering as asyncio '
+                             'tasks, redraw screen this many times per second')
+    parser.add_argument('--record', metavar='FILE',
+                        help='save replay of the game to FILE, play it back '
+                             'with replay.py')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for random numbers, random by default')
+    parser.add_argument('--autosave', metavar='FILE',
+                        help='save game checkpoints to FILE every %s seconds'
+                             % (AUTOSAVE_SECONDS,))
+    parser.add_argument('--load', metavar='FILE',
+                        help='continue game saved with --autosave')
+    parser.add_argument('--perf-log', metavar='FILE',
+                        help='time game phases and save totals to FILE as '
+                             'JSON on exit')
+    args = parser.parse_args()
+    try:
+        curses.wrapper(main, args)
+    except SaveError as e:
+        sys.exit(e)
     print('The end')
     input('Press Enter to exit')
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+""" Generate random maps which always have a route from spawns to exit.
+
+Path is carved along a random spanning tree of a lattice of cells with odd
+row and col, made by randomized depth-first search. Tree has no loops, so
+the route from spawn to exit is the only one, and its length is chosen by
+placing exit on the tree node at the wanted distance from spawn. Branches
+are side corridors of the tree which start at an extra spawn and join the
+main route. Walls next to path become tower cells with given density.
+
+Maps are returned as GameField rows (one character per cell) or saved in
+text format used by the game, same seed always gives the same map.
+"""
+
+import argparse
+import functools
+import os
+import random
+import sys
+import time
+
+from curses_td import GameField
+
+
+@functools.lru_cache(maxsize=None)
+def lattice(node_rows, node_cols):
+    """ Neighbours of every node of lattice, nodes are numbered by rows. """
+    neighbours = []
+    for row in range(node_rows):
+        for col in range(node_cols):
+            node = row * node_cols + col
+            near = []
+            if row > 0:
+                near.append(node - node_cols)
+            if row < node_rows - 1:
+                near.append(node + node_cols)
+            if col > 0:
+                near.append(node - 1)
+            if col < node_cols - 1:
+                near.append(node + 1)
+            neighbours.append(tuple(near))
+    return tuple(neighbours)
+
+
+def spanning_tree(rng, node_rows, node_cols, root):
+    """ Random spanning tree of node lattice.
+
+    Return lists of parent of every node (-1 for root) and its distance
+    from root.
+    """
+    neighbours = lattice(node_rows, node_cols)
+    parents = [-1] * len(neighbours)
+    depths = [0] * len(neighbours)
+    visited = bytearray(len(neighbours))
+    visited[root] = 1
+    stack = [root]
+    random = rng.random
+    while stack:
+        node = stack[-1]
+        free = [near for near in neighbours[node] if not visited[near]]
+        if free:
+            near = free[int(random() * len(free))]
+            visited[near] = 1
+            parents[near] = node
+            depths[near] = depths[node] + 1
+            stack.append(near)
+        else:
+            stack.pop()
+    return parents, depths
+
+
+def tree_path(parents, node, stop=()):
+    """ Nodes from node up to tree root or first node in stop. """
+    path = [node]
+    while node not in stop and parents[node] >= 0:
+        node = parents[node]
+        path.append(node)
+    return path
+
+
+def generate_map(rows=25, cols=25, seed=None, path_length=None, branches=0,
+                 density=0.5):
+    """ Generate map of rows x cols cells as list of GameField rows.
+
+    path_length is wanted number of cells from spawn to exit, the longest
+    possible by default, branches is number of extra spawns joining the
+    route and density is chance for wall cell next to path to be tower
+    cell.
+    """
+    rng = random.Random(seed)
+    node_rows, node_cols = (rows - 1) // 2, (cols - 1) // 2
+    if node_rows * node_cols < 2:
+        raise ValueError('map is too small for spawn and exit')
+    start = rng.randrange(node_rows * node_cols)
+    parents, depths = spanning_tree(rng, node_rows, node_cols, start)
+
+    # route of n nodes has 2n - 1 cells
+    target = (path_length + 1) // 2 - 1 if path_length else max(depths)
+    target = max(target, 1)
+    end = min(range(len(depths)), key=lambda node: abs(depths[node] - target))
+    route = tree_path(parents, end)
+    on_route = set(route)
+
+    # field is kept flat, node (row, col) is cell (2 row + 1, 2 col + 1)
+    field = bytearray(b'b') * (rows * cols)
+    cells = [(node // node_cols * 2 + 1) * cols + node % node_cols * 2 + 1
+             for node in range(node_rows * node_cols)]
+    carved = []
+
+    def carve(nodes):
+        for node, next_node in zip(nodes, nodes[1:]):
+            # cell between two nodes is in the middle of them
+            carved.append(cells[node])
+            carved.append((cells[node] + cells[next_node]) // 2)
+        carved.append(cells[nodes[-1]])
+
+    carve(route)
+    # branch starts at a tree leaf off the route and goes up to the route
+    is_parent = bytearray(len(parents))
+    for parent in parents:
+        if parent >= 0:
+            is_parent[parent] = 1
+    leaves = [node for node in range(len(parents))
+              if not is_parent[node] and node not in on_route]
+    rng.shuffle(leaves)
+    branch_starts = []
+    for leaf in leaves[:branches]:
+        branch = tree_path(parents, leaf, on_route)
+        # creeps do not walk through spawn cells
+        if branch[-1] == start:
+            continue
+        carve(branch)
+        on_route.update(branch)
+        branch_starts.append(leaf)
+
+    for cell in carved:
+        field[cell] = ord('.')
+    # walls touching path, in order they are found; path cells are never on
+    # the border, so all their neighbours are inside the field
+    walls = {}
+    around = (-cols - 1, -cols, -cols + 1, -1, 1, cols - 1, cols, cols + 1)
+    for cell in carved:
+        for offset in around:
+            if field[cell + offset] == ord('b'):
+                walls[cell + offset] = True
+    random_value = rng.random
+    for cell in walls:
+        if random_value() < density:
+            field[cell] = ord('w')
+    for node in [start] + branch_starts:
+        field[cells[node]] = ord('s')
+    field[cells[end]] = ord('e')
+    text = field.decode()
+    return [text[row * cols:(row + 1) * cols] for row in range(rows)]
+
+
+def generate_field(*args, **kwargs):
+    """ Generate map as GameField with routes built. """
+    gf = GameField(generate_map(*args, **kwargs))
+    gf.build_route()
+    return gf
+
+
+def save_map(field, filename):
+    with open(filename, 'w') as f:
+        for line in field:
+            f.write(' '.join(line) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the first map, next maps get next seeds')
+    parser.add_argument('--rows', type=int, default=25)
+    parser.add_argument('--cols', type=int, default=25)
+    parser.add_argument('--path-length', type=int, default=None,
+                        help='cells from spawn to exit, the longest by default')
+    parser.add_argument('--branches', type=int, default=0,
+                        help='extra spawns with corridors joining the route')
+    parser.add_argument('--density', type=float, default=0.5,
+                        help='chance for wall next to path to be tower cell')
+    parser.add_argument('--output-dir', default=None,
+                        help='save maps as DIR/generated_SEED.txt, otherwise '
+                             'only measure generation speed')
+    parser.add_argument('--validate', action='store_true',
+                        help='build route of every map')
+    args = parser.parse_args(argv)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    for seed in range(args.seed, args.seed + args.count):
+        field = generate_map(args.rows, args.cols, seed, args.path_length,
+                             args.branches, args.density)
+        if args.validate:
+            GameField(field).build_route()
+        if args.output_dir:
+            save_map(field, os.path.join(args.output_dir,
+                                         'generated_%s.txt' % (seed,)))
+    seconds = time.perf_counter() - start
+    print('%s maps in %.3f s (%d maps/sec)'
+          % (args.count, seconds, args.count / seconds if seconds else 0))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+""" Play game over network: server simulates, clients watch and play.
+
+Server runs GameController simulation with no terminal and is the only
+place where game is simulated. A few times per second it compares game
+state with the previous frame and sends changes (creeps, towers, gold,
+lifes and the rest of status line) to every client, so one frame covers
+several ticks. Frame is encoded once and the same bytes are written to
+every client, so spectators cost no extra simulation work. A client that
+falls too far behind is dropped and does not hold memory for missed frames.
+
+Clients draw game state with CursesRenderer and send player's commands
+to server. Each client has its own cursor, so commands carry cell they are
+for. Messages in both directions are zlib compressed compact JSON with
+4 byte length header:
+
+    python3 netplay.py serve --map map1.txt --difficulty easy --port 7300
+    python3 netplay.py join --host localhost --port 7300
+    python3 netplay.py join --host localhost --port 7300 --spectate
+"""
+
+import argparse
+import asyncio
+import curses
+import json
+import struct
+import sys
+import zlib
+
+from curses_td import (DIFFICULTY_HP_MULTIPLIER, KEY_COMMANDS, PRICES,
+                       Creep, Cursor, CursesRenderer, ExitGame, GameController,
+                       TowerFactory, init_screen)
+
+
+DEFAULT_PORT = 7300
+# frames sent to clients per second
+BROADCAST_FPS = 20
+# client is dropped when that many bytes wait to be sent to it
+MAX_CLIENT_BUFFER = 1 << 20
+# commands from clients are tiny, anything bigger is not a command
+MAX_COMMAND_SIZE = 1024
+
+HEADER = struct.Struct('!I')
+
+# status line values streamed to clients
+STATUS_FIELDS = ('gold', 'lifes', 'kills', 'level_round', 'rounds', 'sec',
+                 'creep_hp', 'sent_creeps', 'creep_count', 'boss_hp')
+# tower stats shown by renderer, tower image is streamed separately as it
+# changes much more often
+TOWER_STATS = ('level', 'damage', 'speed', 'range', 'price', 'crit_chance',
+               'slow_points')
+# commands accepted from network and number of their arguments; pause is
+# left out, as any client could stop the game for everybody
+NETWORK_COMMANDS = {'send_wave': 0, 'build': 3, 'destroy': 2, 'upgrade': 2}
+
+
+def pack(message):
+    """ Encode message for sending. """
+    payload = zlib.compress(json.dumps(message, separators=(',', ':')).encode(), 1)
+    return HEADER.pack(len(payload)) + payload
+
+
+def unpack(payload):
+    """ Decode message, raise ValueError or zlib.error if malformed. """
+    return json.loads(zlib.decompress(payload))
+
+
+async def read_payload(reader, limit=None):
+    """ Read one encoded message, return None when connection is closed.
+
+    Raise ValueError if message is longer than limit.
+    """
+    try:
+        size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+        if limit is not None and size > limit:
+            raise ValueError('message of %s bytes is too long' % (size,))
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+async def read_message(reader, limit=None):
+    """ Read one message, return None when connection is closed.
+
+    Raise ValueError if message is longer than limit or malformed.
+    """
+    payload = await read_payload(reader, limit)
+    return None if payload is None else unpack(payload)
+
+
+class StateStream():
+
+    """ Game state as seen by clients, turned into frames of changes.
+
+    Message is a dict with keys only for what changed:
+      t - tick, f - field rows (only in full state),
+      c - creeps [id, row, col, hp, image, boss] which appeared or changed,
+      x - ids of creeps which are gone,
+      w - towers [row, col, type, TOWER_STATS...] which appeared or changed,
+      i - tower images [row, col, image], r - [row, col] of removed towers,
+      s - changed STATUS_FIELDS values, end - game is over.
+    """
+
+    def __init__(self):
+        self.ticks = None
+        self.field = None
+        # id of creep object -> short id sent to clients; creeps which
+        # left the game are reused by engine, so ids are reused too
+        self.creep_ids = {}
+        # short id -> creep entry
+        self.creeps = {}
+        # (row, col) -> tower entry and tower image
+        self.towers = {}
+        self.images = {}
+        self.status = {}
+
+    def update(self, engine):
+        """ Remember engine state, return message with changes or None. """
+        message = {}
+        self.field = engine.field
+        creeps = {}
+        creep_ids = self.creep_ids
+        for creep in engine.creeps:
+            creep_id = creep_ids.get(id(creep))
+            if creep_id is None:
+                creep_id = creep_ids[id(creep)] = len(creep_ids)
+            creeps[creep_id] = [creep_id, creep.row, creep.col, creep.hp,
+                                creep.image, int(creep.boss)]
+        changed = [entry for creep_id, entry in creeps.items()
+                   if self.creeps.get(creep_id) != entry]
+        if changed:
+            message['c'] = changed
+        gone = [creep_id for creep_id in self.creeps if creep_id not in creeps]
+        if gone:
+            message['x'] = gone
+        self.creeps = creeps
+
+        towers = {}
+        images = {}
+        for cell, tower in engine.tower_cells.items():
+            towers[cell] = list(cell) + [tower.tower_type] + [
+                getattr(tower, name, None) for name in TOWER_STATS]
+            images[cell] = tower.image
+        changed = [entry for cell, entry in towers.items()
+                   if self.towers.get(cell) != entry]
+        if changed:
+            message['w'] = changed
+        changed = [list(cell) + [image] for cell, image in images.items()
+                   if self.images.get(cell) != image]
+        if changed:
+            message['i'] = changed
+        gone = [list(cell) for cell in self.towers if cell not in towers]
+        if gone:
+            message['r'] = gone
+        self.towers = towers
+        self.images = images
+
+        status = {name: getattr(engine, name) for name in STATUS_FIELDS}
+        changed = {name: value for name, value in status.items()
+                   if self.status.get(name) != value}
+        if changed:
+            message['s'] = changed
+        self.status = status
+        if not message and engine.ticks == self.ticks:
+            return None
+        self.ticks = engine.ticks
+        message['t'] = engine.ticks
+        return message
+
+    def full(self):
+        """ Message with whole remembered state, sent to new clients. """
+        return {'t': self.ticks, 'f': self.field, 'c': list(self.creeps.values()),
+                'w': list(self.towers.values()),
+                'i': [list(cell) + [image] for cell, image in self.images.items()],
+                's': self.status}
+
+
+class RemoteGame():
+
+    """ Copy of game state built from server messages.
+
+    Has attributes of GameEngine which CursesRenderer reads, so remote
+    game is drawn the same way as local one.
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.field = None
+        self.field_rows = self.field_cols = 0
+        self.creep_map = {}
+        self.creeps = []
+        self.tower_cells = {}
+        self.towers = []
+        self.game_over = False
+        for name in STATUS_FIELDS:
+            setattr(self, name, 0)
+
+    def apply(self, message):
+        """ Update state with server message. """
+        if 'f' in message:
+            self.field = message['f']
+            self.field_rows = len(self.field)
+            self.field_cols = len(self.field[0])
+            self.creep_map = {}
+            self.tower_cells = {}
+        for creep_id, row, col, hp, image, boss in message.get('c', ()):
+            creep = self.creep_map.get(creep_id)
+            if creep is None:
+                creep = self.creep_map[creep_id] = Creep(row, col, hp, 0)
+            creep.row, creep.col, creep.hp = row, col, hp
+            creep.image, creep.boss = image, bool(boss)
+        for creep_id in message.get('x', ()):
+            del self.creep_map[creep_id]
+        for row, col, tower_type, *stats in message.get('w', ()):
+            tower = self.tower_cells.get((row, col))
+            if tower is None or tower.tower_type != tower_type:
+                tower = self.tower_cells[(row, col)] = TowerFactory(tower_type, row, col)
+            for name, value in zip(TOWER_STATS, stats):
+                if value is not None:
+                    setattr(tower, name, value)
+        for row, col, image in message.get('i', ()):
+            self.tower_cells[(row, col)].image = image
+        for row, col in message.get('r', ()):
+            del self.tower_cells[(row, col)]
+        for name, value in message.get('s', {}).items():
+            setattr(self, name, value)
+        self.ticks = message.get('t', self.ticks)
+        self.game_over = message.get('end', self.game_over)
+        self.creeps = list(self.creep_map.values())
+        self.towers = list(self.tower_cells.values())
+
+    def find_tower(self, row, col):
+        return self.tower_cells.get((row, col))
+
+
+class GameServer():
+
+    """ Stream game of GameController to clients and take their commands.
+
+    Server is controller's renderer: every drawn frame is a frame sent to
+    clients. serve() is controller's input source.
+    """
+
+    stats = None
+    perf_overlay = False
+
+    def __init__(self, host='localhost', port=DEFAULT_PORT, accept_commands=True):
+        self.host = host
+        self.port = port
+        self.accept_commands = accept_commands
+        self.stream = StateStream()
+        self.engine = None
+        self.commands = None
+        # writers of connected clients
+        self.clients = set()
+        self.listening = asyncio.Event()
+
+    def draw(self, engine, cursor):
+        self.engine = engine
+        message = self.stream.update(engine)
+        if message is not None:
+            self.send_all(pack(message))
+
+    def send_all(self, data):
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                # too slow to keep up, drop it instead of buffering frames
+                self.clients.discard(writer)
+                writer.close()
+            else:
+                writer.write(data)
+
+    async def serve(self, commands):
+        """ Accept clients and put their commands to commands queue. """
+        self.commands = commands
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self.listening.set()
+        async with server:
+            await server.serve_forever()
+
+    def parse_command(self, message):
+        """ Command tuple for GameController.execute, None if invalid. """
+        if not (isinstance(message, list) and message and
+                isinstance(message[0], str)):
+            return None
+        command, *args = message
+        if NETWORK_COMMANDS.get(command) != len(args) or not self.accept_commands:
+            return None
+        if command == 'build':
+            if not isinstance(args[0], str) or args[0] not in PRICES:
+                return None
+            args = args[1:]
+        row, col = args or (0, 0)
+        if not (isinstance(row, int) and isinstance(col, int) and
+                0 <= row < self.engine.field_rows and
+                0 <= col < self.engine.field_cols):
+            return None
+        return tuple(message)
+
+    async def handle_client(self, reader, writer):
+        writer.write(pack(self.stream.full()))
+        self.clients.add(writer)
+        try:
+            while True:
+                payload = await read_payload(reader, MAX_COMMAND_SIZE)
+                if payload is None:
+                    break
+                try:
+                    command = self.parse_command(unpack(payload))
+                except (ValueError, RecursionError, zlib.error):
+                    # malformed command is ignored like an invalid one
+                    continue
+                if command is not None:
+                    await self.commands.put(command)
+        except (ConnectionError, ValueError):
+            # connection is lost or client sends something else than commands
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def close(self):
+        """ Send final frame and disconnect clients. """
+        if self.engine is not None:
+            message = self.stream.update(self.engine) or {}
+            message['end'] = True
+            self.send_all(pack(message))
+        clients = list(self.clients)
+        self.clients.clear()
+        for writer in clients:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def run_server(controller, server, broadcast_fps=BROADCAST_FPS):
+    """ Run game of controller until it is over, streaming it with server. """
+    server.draw(controller.engine, controller.cursor)
+    try:
+        await controller.run_async(broadcast_fps, [server.serve], keyboard=False)
+    except ExitGame:
+        pass
+    finally:
+        await server.close()
+        controller.save_replay()
+
+
+class GameClient():
+
+    """ Draw game streamed by server on curses screen, send player's keys. """
+
+    def __init__(self, stdscr, host='localhost', port=DEFAULT_PORT,
+                 spectate=False):
+        self.stdscr = stdscr
+        self.host = host
+        self.port = port
+        self.spectate = spectate
+        self.game = RemoteGame()
+        self.renderer = CursesRenderer(stdscr)
+        self.cursor = None
+        self.writer = None
+
+    def handle_key(self, c):
+        """ Move cursor or send command bound to pressed key. """
+        if c not in KEY_COMMANDS or self.cursor is None:
+            return
+        command, *args = KEY_COMMANDS[c]
+        if command == 'quit':
+            raise ExitGame
+        if command == 'move':
+            getattr(self.cursor, 'move_' + args[0])()
+            self.renderer.draw(self.game, self.cursor)
+        elif command in NETWORK_COMMANDS and not self.spectate:
+            if NETWORK_COMMANDS[command]:
+                args += [self.cursor.row, self.cursor.col]
+            self.writer.write(pack([command] + args))
+
+    async def read_keys(self):
+        loop = asyncio.get_running_loop()
+        key_pressed = asyncio.Event()
+        loop.add_reader(sys.stdin.fileno(), key_pressed.set)
+        try:
+            while True:
+                await key_pressed.wait()
+                key_pressed.clear()
+                c = self.stdscr.getch()
+                while c != -1:
+                    self.handle_key(c)
+                    c = self.stdscr.getch()
+        finally:
+            loop.remove_reader(sys.stdin.fileno())
+
+    async def receive(self, reader):
+        """ Apply server messages and draw every frame. """
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                raise ExitGame
+            self.game.apply(message)
+            if self.cursor is None:
+                self.cursor = Cursor(0, 0, self.game.field_rows, self.game.field_cols)
+            self.renderer.draw(self.game, self.cursor)
+            if self.game.game_over:
+                raise ExitGame
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        tasks = [asyncio.ensure_future(self.receive(reader)),
+                 asyncio.ensure_future(self.read_keys())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.writer.close()
+
+    def start(self):
+        self.stdscr.clear()
+        self.stdscr.nodelay(True)
+        try:
+            asyncio.run(self.run())
+        except ExitGame:
+            pass
+        finally:
+            self.stdscr.nodelay(False)
+
+
+def join(stdscr, args):
+    init_screen()
+    GameClient(stdscr, args.host, args.port, args.spectate).start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    modes = parser.add_subparsers(dest='mode', required=True)
+    serve = modes.add_parser('serve', help='simulate game and stream it')
+    serve.add_argument('--map', required=True)
+    serve.add_argument('--difficulty', default='easy',
+                       choices=list(DIFFICULTY_HP_MULTIPLIER))
+    serve.add_argument('--host', default='localhost',
+                       help='address to listen on, 0.0.0.0 for all')
+    serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve.add_argument('--broadcast-fps', type=int, default=BROADCAST_FPS,
+                       help='frames sent to clients per second')
+    serve.add_argument('--spectators-only', action='store_true',
+                       help='ignore commands from clients')
+    serve.add_argument('--maze', action='store_true')
+    serve.add_argument('--seed', type=int, default=None)
+    serve.add_argument('--record', metavar='FILE',
+                       help='save replay of the game to FILE')
+    client = modes.add_parser('join', help='watch and play game from server')
+    client.add_argument('--host', default='localhost')
+    client.add_argument('--port', type=int, default=DEFAULT_PORT)
+    client.add_argument('--spectate', action='store_true',
+                        help='only watch, keys do not change the game')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'join':
+        curses.wrapper(join, args)
+        return 0
+    server = GameServer(args.host, args.port, not args.spectators_only)
+    controller = GameController(None, renderer=server, record=args.record,
+                                seed=args.seed, maze=args.maze)
+    controller.setup_map(args.map, args.difficulty)
+    print('Serving %s on %s:%s' % (args.map, args.host, args.port))
+    asyncio.run(run_server(controller, server, args.broadcast_fps))
+    print('Game over: round %s, lifes %s, kills %s'
+          % (controller.engine.level_round, controller.engine.lifes,
+             controller.engine.kills))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+""" Search tower layouts and upgrade orders which win a map.
+
+Candidates are build orders in the format of sweep.py placement scripts:
+actions [key, row, col] performed one by one as soon as there is enough
+gold, so gold income decides when each tower is built. Search is
+evolutionary: the first generation is made of built-in strategies for every
+tower type and random orders, every next one keeps the best candidates and
+adds their mutated and crossed over copies.
+
+Candidates are scored by headless games on all CPU cores: won games first,
+then more rounds cleared, more lifes left and more gold saved. A game is
+stopped early when it is clearly losing: when at the start of some round it
+has fewer lifes than the worst candidate kept so far had at the same round,
+minus a margin. Build order played by the same seed always scores the
+same, so orders which were played already are not played again.
+
+Best build order is saved as JSON placement script which sweep.py plays:
+
+    python3 optimizer.py --map map1.txt --difficulty hard --output best.json
+    python3 sweep.py --maps map1.txt --placements best.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from curses_td import (DIFFICULTY_HP_MULTIPLIER, LIFES, PRICES, TOWER_MAX_LEVEL,
+                       TOWERS, make_engine)
+from sweep import MAX_TICKS, BuildOrder, strategy_actions
+
+
+# lifes candidate may be behind the worst kept candidate before it is stopped
+CUTOFF_MARGIN = LIFES // 4
+# actions kept after the last one game got to, so mutations change actions
+# which matter
+SPARE_ACTIONS = 10
+
+
+def candidate_cells(engine, count):
+    """ Tower cells covering the most of creep path, best first.
+
+    Coverage is counted for every tower type with its range, cells are
+    taken from the top of each type in turn.
+    """
+    rankings = []
+    for tower_type in sorted(TOWERS):
+        ranked = []
+        for key, row, col in strategy_actions(engine, tower_type):
+            if key == 'u':
+                break
+            ranked.append((row, col))
+        rankings.append(ranked)
+    cells = []
+    for ranked_cells in zip(*rankings):
+        for cell in ranked_cells:
+            if cell not in cells:
+                cells.append(cell)
+    return cells[:count]
+
+
+def evaluate(task):
+    """ Play build order headless and return its score.
+
+    cutoff is list of lifes at start of rounds 2, 3... under which game is
+    stopped as losing, it may be shorter than the game.
+    """
+    map_name, difficulty, actions, seed, cutoff, backend = task
+    engine = make_engine(backend, seed)
+    engine.setup_map(map_name, difficulty)
+    build_order = BuildOrder(actions)
+    # lifes at start of every round after the first one
+    profile = []
+    cut = False
+    skipped = 0
+    while engine.ticks < MAX_TICKS:
+        build_order.play(engine)
+        skipped += engine.skip_idle()
+        level_round = engine.level_round
+        if not engine.step():
+            break
+        if engine.level_round != level_round and level_round:
+            profile.append(engine.lifes)
+            if len(profile) <= len(cutoff) and engine.lifes < cutoff[len(profile) - 1]:
+                cut = True
+                break
+    won = engine.game_over and engine.lifes > 0
+    rounds = engine.level_round if won else max(engine.level_round - 1, 0)
+    lifes = max(engine.lifes, 0)
+    return {'actions': actions[:build_order.position + SPARE_ACTIONS],
+            'score': [int(won), rounds, lifes, engine.gold],
+            'won': won, 'rounds': rounds, 'lifes': lifes, 'gold': engine.gold,
+            'ticks': engine.ticks, 'skipped_ticks': skipped, 'cut': cut,
+            'profile': profile}
+
+
+def random_actions(rng, cells, length):
+    """ Random build order: towers on cells and upgrades of them. """
+    actions = []
+    built = []
+    for _ in range(length):
+        if built and rng.random() < 0.4:
+            actions.append(['u'] + list(rng.choice(built)))
+        else:
+            row, col = rng.choice(cells)
+            actions.append([rng.choice(sorted(PRICES)), row, col])
+            built.append((row, col))
+    return actions
+
+
+def mutate(rng, actions, cells):
+    """ Copy of build order with one random change. """
+    actions = [list(action) for action in actions]
+    builds = [n for n, action in enumerate(actions) if action[0] in PRICES]
+    change = rng.randrange(6)
+    if change == 0 or not actions:
+        # build new tower
+        row, col = rng.choice(cells)
+        actions.insert(rng.randint(0, len(actions)),
+                       [rng.choice(sorted(PRICES)), row, col])
+    elif change == 1 and builds:
+        # upgrade some tower after it is built
+        n = rng.choice(builds)
+        actions.insert(rng.randint(n + 1, len(actions)), ['u'] + actions[n][1:])
+    elif change == 2:
+        del actions[rng.randrange(len(actions))]
+    elif change == 3 and len(actions) > 1:
+        # do one action earlier
+        n = rng.randrange(1, len(actions))
+        actions[n - 1], actions[n] = actions[n], actions[n - 1]
+    elif change == 4 and builds:
+        actions[rng.choice(builds)][0] = rng.choice(sorted(PRICES))
+    elif builds:
+        # move tower with its upgrades to another cell
+        old_cell = actions[rng.choice(builds)][1:]
+        new_cell = list(rng.choice(cells))
+        for action in actions:
+            if action[1:] == old_cell:
+                action[1:] = new_cell
+    return actions
+
+
+def crossover(rng, first, second):
+    """ Beginning of one build order followed by the end of another one. """
+    return ([list(action) for action in first[:rng.randint(0, len(first))]] +
+            [list(action) for action in second[rng.randint(0, len(second)):]])
+
+
+def max_upgrades(actions):
+    """ Drop upgrades over TOWER_MAX_LEVEL, they would be skipped anyway. """
+    levels = {}
+    kept = []
+    for key, row, col in actions:
+        if key == 'u':
+            if levels.get((row, col), TOWER_MAX_LEVEL) >= TOWER_MAX_LEVEL:
+                continue
+            levels[(row, col)] += 1
+        else:
+            levels[(row, col)] = 1
+        kept.append([key, row, col])
+    return kept
+
+
+def optimize(map_name, difficulty, generations=10, population=24, elite=6,
+             cells=20, seed=0, game_seed=0, processes=None, backend='python',
+             log=None):
+    """ Return results of the best build order found for map and difficulty.
+
+    log is called with generation number, best result, number of games
+    played and cut in generation and seconds taken.
+    """
+    rng = random.Random(seed)
+    engine = make_engine(backend, game_seed)
+    engine.setup_map(map_name, difficulty)
+    cells = candidate_cells(engine, cells)
+    if not cells:
+        raise ValueError('map has no tower cells near creep path')
+
+    candidates = [strategy_actions(engine, tower_type) for tower_type in sorted(TOWERS)]
+    while len(candidates) < population:
+        candidates.append(random_actions(rng, cells, rng.randint(5, 40)))
+
+    # build order -> its result, same order always plays the same game
+    played = {}
+    kept = []
+    with multiprocessing.Pool(processes) as pool:
+        for generation in range(generations):
+            start = time.perf_counter()
+            cutoff = ([lifes - CUTOFF_MARGIN for lifes in kept[-1]['profile']]
+                      if len(kept) >= elite else [])
+            tasks = []
+            for actions in candidates:
+                key = json.dumps(actions)
+                if key not in played:
+                    played[key] = None
+                    tasks.append((map_name, difficulty, actions, game_seed,
+                                  cutoff, backend))
+            results = pool.map(evaluate, tasks)
+            for task, result in zip(tasks, results):
+                played[json.dumps(task[2])] = result
+            kept = sorted(kept + results, key=lambda result: result['score'],
+                          reverse=True)[:elite]
+            if log is not None:
+                log(generation, kept[0], len(results),
+                    sum(result['cut'] for result in results),
+                    time.perf_counter() - start)
+
+            candidates = []
+            while len(candidates) < population:
+                first = rng.choice(kept)['actions']
+                if rng.random() < 0.3:
+                    child = crossover(rng, first, rng.choice(kept)['actions'])
+                else:
+                    child = first
+                child = mutate(rng, child, cells)
+                for _ in range(rng.randrange(3)):
+                    child = mutate(rng, child, cells)
+                candidates.append(max_upgrades(child))
+    return kept[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--map', required=True)
+    parser.add_argument('--difficulty', default='easy',
+                        choices=list(DIFFICULTY_HP_MULTIPLIER))
+    parser.add_argument('--generations', type=int, default=10)
+    parser.add_argument('--population', type=int, default=24,
+                        help='build orders played in every generation')
+    parser.add_argument('--elite', type=int, default=6,
+                        help='best build orders kept for the next generation')
+    parser.add_argument('--cells', type=int, default=20,
+                        help='number of best covering cells to build on')
+    parser.add_argument('--seed', type=int, default=0, help='seed of search')
+    parser.add_argument('--game-seed', type=int, default=0,
+                        help='seed of games candidates are played in')
+    parser.add_argument('--backend', choices=['python', 'numpy'],
+                        default='python',
+                        help='numpy backend is faster for huge creep waves')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, all CPU cores by default')
+    parser.add_argument('--output', default=None,
+                        help='save best build order as sweep.py placement '
+                             'script to this JSON file')
+    parser.add_argument('--name', default='optimized',
+                        help='placement name in output file')
+    args = parser.parse_args(argv)
+
+    def log(generation, best, games, cut, seconds):
+        print('generation %s: best %s, rounds %s, lifes %s, gold %s; '
+              '%s games, %s cut early, %.1f s'
+              % (generation, 'won' if best['won'] else 'lost', best['rounds'],
+                 best['lifes'], best['gold'], games, cut, seconds))
+        sys.stdout.flush()
+
+    best = optimize(args.map, args.difficulty, args.generations,
+                    args.population, args.elite, args.cells, args.seed,
+                    args.game_seed, args.processes, args.backend, log)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({args.name: best['actions']}, f)
+    else:
+        print(json.dumps(best['actions']))
+    return 0 if best['won'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+""" Play back recorded game headless at maximum speed.
+
+Record a game with `curses_td.py --record game.replay`, then re-simulate it
+with `replay.py game.replay`. Exit status is 1 if the game did not end in
+exactly the same state as recorded one.
+"""
+
+import argparse
+import sys
+import time
+
+from curses_td import Replay, make_engine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('replays', nargs='+', metavar='REPLAY')
+    parser.add_argument('--backend', choices=['python', 'numpy'],
+                        default='python')
+    args = parser.parse_args(argv)
+
+    status = 0
+    for filename in args.replays:
+        replay = Replay.load(filename)
+        engine = make_engine(args.backend, replay.seed)
+        start = time.perf_counter()
+        same = replay.play(engine)
+        seconds = time.perf_counter() - start
+        print('%s: %s ticks in %.3f s (%d ticks/sec), round %s, gold %s, '
+              'lifes %s, kills %s - %s'
+              % (filename, engine.ticks, seconds,
+                 engine.ticks / seconds if seconds else 0, engine.level_round,
+                 engine.gold, engine.lifes, engine.kills,
+                 'same state' if same else 'STATE MISMATCH'))
+        if not same:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+""" Run many headless games in parallel to tune game balance.
+
+Every combination of map, difficulty and tower placement script is played
+by GameEngine on all CPU cores, results are streamed to CSV or JSONL file
+as soon as each game finishes.
+
+Placement script is a build order: list of actions [key, row, col] where key
+is the same key player presses in game - tower type to build it, 'u' to
+upgrade tower, 'd' to destroy it. Actions are performed one by one as soon
+as there is enough gold. Scripts are loaded from JSON file with
+{"name": [[key, row, col], ...]} object or generated by built-in strategy
+named after tower type (e.g. 'minigun' builds and upgrades minigun towers
+on cells covering the most of creep path).
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+import time
+
+import curses_td
+from curses_td import (DIFFICULTY_HP_MULTIPLIER, MAX_ROUNDS, PRICES,
+                       TOWER_MAX_LEVEL, TOWER_UPGRADE_PRICE_MULTIPLIER, TOWERS,
+                       make_engine)
+
+
+MAPS = [curses_td.MAP_FILE % (level,) for level in range(1, 6)]
+
+STRATEGIES = {'none': None, 'chainsaw': 'c', 'minigun': 'm', 'sniper': 's',
+              'ice': 'i'}
+
+# Safety net for games which never end, e.g. when spawn point is blocked.
+MAX_TICKS = 2 * MAX_ROUNDS * curses_td.TIME_BETWEEN_WAVES * curses_td.FPS
+
+FIELDS = ['map', 'difficulty', 'placement', 'seed', 'won', 'rounds',
+          'lifes', 'gold', 'kills', 'ticks', 'skipped_ticks', 'seconds',
+          'ticks_per_sec']
+
+
+class BuildOrder():
+
+    """ Class designed to play scripted build order in headless game. """
+
+    def __init__(self, actions):
+        self.actions = list(actions)
+        self.position = 0
+
+    def action_price(self, engine, key, row, col):
+        """ Return gold needed for action or None if action is impossible. """
+        if key in PRICES:
+            if engine.is_free_place_for_tower(row, col):
+                return PRICES[key]
+            return None
+        tower = engine.find_tower(row, col)
+        if tower is None:
+            return None
+        if key == 'u':
+            if tower.level >= TOWER_MAX_LEVEL:
+                return None
+            return tower.level * PRICES[tower.tower_type] * TOWER_UPGRADE_PRICE_MULTIPLIER
+        return 0
+
+    def play(self, engine):
+        """ Perform all next actions player can afford now. """
+        while self.position < len(self.actions):
+            key, row, col = self.actions[self.position]
+            price = self.action_price(engine, key, row, col)
+            if price is not None:
+                if engine.gold < price:
+                    break
+                if key == 'u':
+                    engine.upgrade_tower(row, col)
+                elif key == 'd':
+                    engine.destroy_tower(row, col)
+                else:
+                    engine.build_tower(key, row, col)
+            self.position += 1
+
+
+def strategy_actions(engine, tower_type):
+    """ Build order filling cells which cover the most of creep path. """
+    tower_range = TOWERS[tower_type]['range']
+    cells = []
+    for row in range(engine.field_rows):
+        for col in range(engine.field_cols):
+            if engine.is_free_place_for_tower(row, col):
+                coverage = sum(1 for path_row, path_col in engine.creep_path
+                               if abs(path_row - row) <= tower_range and
+                               abs(path_col - col) <= tower_range)
+                if coverage:
+                    cells.append((-coverage, row, col))
+    cells.sort()
+    actions = [[tower_type, row, col] for _, row, col in cells]
+    for _ in range(TOWER_MAX_LEVEL - 1):
+        actions.extend(['u', row, col] for _, row, col in cells)
+    return actions
+
+
+def run_game(map_name, difficulty, placement, actions=None, seed=0,
+             max_ticks=MAX_TICKS, backend='python'):
+    """ Play one game headless and return its results. """
+    engine = make_engine(backend, seed)
+    engine.setup_map(map_name, difficulty)
+    if actions is None:
+        tower_type = STRATEGIES[placement]
+        actions = strategy_actions(engine, tower_type) if tower_type else []
+    build_order = BuildOrder(actions)
+    # ticks fast-forwarded while waiting for waves, they are part of game
+    # time but not of simulation speed
+    skipped = 0
+    start = time.perf_counter()
+    while engine.ticks < max_ticks:
+        build_order.play(engine)
+        skipped += engine.skip_idle()
+        if not engine.step():
+            break
+    seconds = time.perf_counter() - start
+    won = engine.game_over and engine.lifes > 0
+    return {'map': map_name, 'difficulty': difficulty, 'placement': placement,
+            'seed': seed, 'won': won,
+            'rounds': engine.level_round if won else max(engine.level_round - 1, 0),
+            'lifes': max(engine.lifes, 0), 'gold': engine.gold,
+            'kills': engine.kills, 'ticks': engine.ticks,
+            'skipped_ticks': skipped, 'seconds': round(seconds, 3),
+            'ticks_per_sec': round((engine.ticks - skipped) / seconds) if seconds else 0}
+
+
+def run_task(task):
+    return run_game(*task)
+
+
+def load_placements(names):
+    """ Map placement name to its actions, None for built-in strategies. """
+    placements = {}
+    for name in names:
+        if name in STRATEGIES:
+            placements[name] = None
+        else:
+            with open(name) as f:
+                placements.update(json.load(f))
+    return placements
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--maps', nargs='+', default=MAPS)
+    parser.add_argument('--difficulties', nargs='+',
+                        default=list(DIFFICULTY_HP_MULTIPLIER),
+                        choices=list(DIFFICULTY_HP_MULTIPLIER))
+    parser.add_argument('--placements', nargs='+', default=list(STRATEGIES),
+                        help='built-in strategies (%s) or JSON files with '
+                             'build orders' % (', '.join(STRATEGIES),))
+    parser.add_argument('--seeds', type=int, default=1,
+                        help='number of games per combination')
+    parser.add_argument('--backend', choices=['python', 'numpy'],
+                        default='python',
+                        help='numpy backend is faster for huge creep waves')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, all CPU cores by default')
+    parser.add_argument('--output', default='-',
+                        help='result file, .csv or .jsonl (default: stdout)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default=None)
+    args = parser.parse_args(argv)
+
+    output_format = args.format or ('csv' if args.output.endswith('.csv') else 'jsonl')
+    placements = load_placements(args.placements)
+    tasks = [(map_name, difficulty, name, actions, seed, MAX_TICKS, args.backend)
+             for map_name in args.maps
+             for difficulty in args.difficulties
+             for name, actions in placements.items()
+             for seed in range(args.seeds)]
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    try:
+        if output_format == 'csv':
+            writer = csv.DictWriter(out, FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda result: out.write(json.dumps(result) + '\n')
+        with multiprocessing.Pool(args.processes) as pool:
+            for result in pool.imap_unordered(run_task, tasks):
+                write(result)
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import struct
+import zlib
+
+import pytest
+
+from curses_td import Checkpointer, GameController, GameEngine, MapCache, SaveError
+from sweep import BuildOrder, strategy_actions
+
+
+def play(engine, build_order, ticks):
+    for _ in range(ticks):
+        build_order.play(engine)
+        engine.skip_idle()
+        engine.step()
+
+
+def restored(state):
+    engine = GameEngine()
+    engine.restore(state)
+    return engine
+
+
+@pytest.fixture
+def game():
+    engine = GameEngine(7)
+    engine.setup_map('map1.txt', 'easy')
+    # enough gold for ice towers, which put timed effects on creeps
+    engine.gold = 1000
+    return engine, BuildOrder(strategy_actions(engine, 'i'))
+
+
+def test_checkpoints_restore_game(tmp_path, game):
+    engine, build_order = game
+    checkpointer = Checkpointer(str(tmp_path / 'game.sav'), full_every=3)
+    for _ in range(8):
+        play(engine, build_order, 500)
+        checkpointer.save(engine)
+        loaded = restored(Checkpointer.load(checkpointer.filename))
+        assert loaded.state_digest() == engine.state_digest()
+    # game goes on the same way from loaded state
+    play(engine, BuildOrder([]), 1000)
+    play(loaded, BuildOrder([]), 1000)
+    assert loaded.state_digest() == engine.state_digest()
+
+
+@pytest.mark.parametrize('cut', [1, 5, 20])
+def test_truncated_checkpoint_is_skipped(tmp_path, game, cut):
+    engine, build_order = game
+    checkpointer = Checkpointer(str(tmp_path / 'game.sav'))
+    digests = []
+    sizes = []
+    for _ in range(3):
+        play(engine, build_order, 500)
+        checkpointer.save(engine)
+        digests.append(engine.state_digest())
+        sizes.append(os.path.getsize(checkpointer.filename))
+    # the last complete checkpoint is loaded
+    for n in (2, 1):
+        with open(checkpointer.filename, 'r+b') as f:
+            f.truncate(sizes[n] - cut)
+        loaded = restored(Checkpointer.load(checkpointer.filename))
+        assert loaded.state_digest() == digests[n - 1]
+    with open(checkpointer.filename, 'r+b') as f:
+        f.truncate(sizes[0] - cut)
+    with pytest.raises(ValueError):
+        Checkpointer.load(checkpointer.filename)
+
+
+
+def test_save_for_unknown_map_is_refused(tmp_path, game):
+    engine, build_order = game
+    play(engine, build_order, 500)
+    map_name = str(tmp_path / 'map1.txt')
+    shutil.copy('map1.txt', map_name)
+    engine.map_name = map_name
+    checkpointer = Checkpointer(str(tmp_path / 'game.sav'))
+    checkpointer.save(engine)
+    with pytest.raises(SaveError):
+        GameController(None).load_game(checkpointer.filename)
+    assert not os.path.exists(MapCache.filename(map_name))
+    # map given with --map is loaded
+    controller = GameController(None)
+    controller.load_game(checkpointer.filename, [map_name])
+    assert controller.engine.state_digest() == engine.state_digest()
+
+
+@pytest.mark.parametrize('content', [
+    b'junk', b'F\0\0\0\4abcd',
+    # complete records of wrong kind of state
+    b'F' + struct.pack('>I', len(zlib.compress(b'[]'))) + zlib.compress(b'[]'),
+    b'F' + struct.pack('>I', len(zlib.compress(b'{}'))) + zlib.compress(b'{}')])
+def test_broken_save_is_reported(tmp_path, content):
+    filename = tmp_path / 'game.sav'
+    filename.write_bytes(content)
+    with pytest.raises(SaveError):
+        GameController(None).load_game(str(filename))
+
+
+def test_missing_save_is_reported(tmp_path):
+    with pytest.raises(SaveError):
+        GameController(None).load_game(str(tmp_path / 'game.sav'))
@@ -0,0 +1,66 @@
+import os
+import shutil
+
+import pytest
+
+from curses_td import GameField, MapCache
+from map_generator import generate_map
+
+
+@pytest.fixture
+def map_name(tmp_path):
+    name = str(tmp_path / 'map1.txt')
+    shutil.copy('map1.txt', name)
+    return name
+
+
+def loaded(map_name):
+    gf = GameField()
+    gf.load(map_name)
+    return gf
+
+
+def header(map_name):
+    with open(MapCache.filename(map_name), 'rb') as f:
+        return MapCache.HEADER.unpack(f.read(MapCache.HEADER.size))
+
+
+@pytest.mark.parametrize('cut', [1, 4, 6, 8, 100])
+def test_truncated_cache_is_rebuilt(map_name, cut):
+    expected = loaded(map_name)
+    cache_name = MapCache.filename(map_name)
+    size = os.path.getsize(cache_name)
+    with open(cache_name, 'r+b') as f:
+        f.truncate(size - cut)
+    gf = loaded(map_name)
+    assert gf.field == expected.field
+    assert gf.spawns == expected.spawns
+    assert list(gf.path_next) == list(expected.path_next)
+    assert os.path.getsize(cache_name) == size
+
+
+def test_touched_source_is_stamped(map_name):
+    loaded(map_name)
+    stat = os.stat(map_name)
+    os.utime(map_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    gf = GameField()
+    assert not MapCache.read(gf, MapCache.filename(map_name), os.stat(map_name))
+    loaded(map_name)
+    assert header(map_name)[3] == stat.st_mtime_ns + 10 ** 9
+    # next load trusts the stamp and does not hash source again
+    assert MapCache.read(gf, MapCache.filename(map_name), os.stat(map_name))
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'),
+                    reason='needs /proc to count open files')
+def test_loaded_maps_do_not_keep_files_open(tmp_path):
+    open_files = len(os.listdir('/proc/self/fd'))
+    for seed in range(200):
+        map_name = str(tmp_path / ('map%s.txt' % (seed,)))
+        with open(map_name, 'w') as f:
+            f.write('\n'.join(generate_map(11, 11, seed=seed)) + '\n')
+        # compiled on the first load, read from .tdmap on the second
+        loaded(map_name)
+        gf = GameField()
+        assert MapCache.read(gf, MapCache.filename(map_name), os.stat(map_name))
+    assert len(os.listdir('/proc/self/fd')) <= open_files
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from curses_td import GameField
+from map_generator import generate_map
+
+
+def open_walls(rows, rng, chance):
+    """ Turn some wall cells into path, so routes have alternatives. """
+    return [''.join('.' if cell in 'bw' and 0 < row < len(rows) - 1 and
+                    0 < col < len(line) - 1 and rng.random() < chance else cell
+                    for col, cell in enumerate(line))
+            for row, line in enumerate(rows)]
+
+
+def full_route(gf):
+    """ Flow field built from scratch with blocked cells as walls. """
+    field = [''.join('b' if (row, col) in gf.blocked else cell
+                     for col, cell in enumerate(line))
+             for row, line in enumerate(gf.field)]
+    reference = GameField(field)
+    reference.build_route()
+    return [list(line) for line in reference.route]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_repair_matches_full_recomputation(seed):
+    rng = random.Random(seed)
+    rows = generate_map(15 + seed % 3 * 6, 15 + seed % 4 * 4, seed=seed,
+                        branches=seed % 3)
+    gf = GameField(open_walls(rows, rng, 0.3))
+    gf.build_route()
+    gf.open_maze()
+    path_cells = gf.find_cells('.')
+    for _ in range(150):
+        if gf.blocked and rng.random() < 0.4:
+            cell = rng.choice(sorted(gf.blocked))
+            changed = gf.unblock(*cell)
+        else:
+            cell = rng.choice(path_cells)
+            if cell in gf.blocked:
+                continue
+            before = [list(line) for line in gf.route]
+            changed = gf.block(*cell)
+            if changed is None:
+                # refused block changes nothing
+                assert cell not in gf.blocked
+                assert [list(line) for line in gf.route] == before
+                continue
+        assert [list(line) for line in gf.route] == full_route(gf)
+        gf.reindex(changed)
+        reachable = sorted(((row, col) for row in range(len(gf.field))
+                            for col in range(len(gf.field[row]))
+                            if gf.route[row][col] >= 0), key=gf.path_order)
+        assert gf.creep_path == reachable
+        for index, (row, col) in enumerate(gf.creep_path):
+            assert gf.path_next[index] == gf.path_indices[gf.find_next_cell(row, col)]
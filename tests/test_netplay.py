@@ -0,0 +1,88 @@
+import asyncio
+import struct
+import zlib
+
+from curses_td import GameController
+from netplay import (MAX_COMMAND_SIZE, GameServer, pack, read_message,
+                     run_server)
+
+MALFORMED = [
+    [['x'], 1],
+    ['build', ['m'], 1, 1],
+    ['build', {'m': 1}, 1, 1],
+    ['build', 'm', '1', 2],
+    ['build', 'x', 1, 1],
+    ['build', 'm', 1],
+    ['build', 'm', 999, 999],
+    ['upgrade', 1.5, 2],
+    ['destroy', None, None],
+    ['send_wave', 1],
+    ['quit'],
+    ['pause'],
+    [None],
+    [],
+    'build',
+    {'build': 1},
+    5,
+    None,
+]
+
+
+def free_cell(engine):
+    return next((row, col) for row in range(engine.field_rows)
+                for col in range(engine.field_cols)
+                if engine.is_free_place_for_tower(row, col))
+
+
+def test_malformed_commands_are_ignored():
+    server = GameServer()
+    controller = GameController(None, renderer=server, seed=1)
+    controller.setup_map('map1.txt', 'easy')
+    server.draw(controller.engine, controller.cursor)
+    for message in MALFORMED:
+        assert server.parse_command(message) is None
+    row, col = free_cell(controller.engine)
+    assert server.parse_command(['build', 'c', row, col]) == ('build', 'c', row, col)
+    assert server.parse_command(['send_wave']) == ('send_wave',)
+
+
+async def play_over_localhost():
+    server = GameServer(port=0)
+    controller = GameController(None, renderer=server, seed=1)
+    controller.setup_map('map1.txt', 'easy')
+    row, col = free_cell(controller.engine)
+    game = asyncio.ensure_future(run_server(controller, server))
+    try:
+        await asyncio.wait_for(server.listening.wait(), 5)
+        reader, writer = await asyncio.open_connection('localhost', server.port)
+        assert 'f' in await read_message(reader)
+        for message in MALFORMED:
+            writer.write(pack(message))
+        # payloads which are not compressed JSON
+        for payload in (b'abc', zlib.compress(b'[1,'), zlib.compress(b'[' * 100000)):
+            writer.write(struct.pack('!I', len(payload)) + payload)
+        writer.write(pack(['build', 'c', row, col]))
+        while True:
+            message = await asyncio.wait_for(read_message(reader), 5)
+            assert message is not None
+            if [row, col] in [tower[:2] for tower in message.get('w', ())]:
+                break
+        # client sending too long message is disconnected
+        other_reader, other_writer = await asyncio.open_connection(
+            'localhost', server.port)
+        other_writer.write(struct.pack('!I', MAX_COMMAND_SIZE + 1))
+        while await asyncio.wait_for(other_reader.read(1 << 16), 5):
+            pass
+        # first client is still served
+        assert await asyncio.wait_for(read_message(reader), 5) is not None
+        writer.close()
+        other_writer.close()
+    finally:
+        game.cancel()
+        await asyncio.gather(game, return_exceptions=True)
+    return controller.engine
+
+
+def test_commands_over_localhost():
+    engine = asyncio.run(play_over_localhost())
+    assert len(engine.towers) == 1
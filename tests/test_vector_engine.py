@@ -0,0 +1,81 @@
+import pytest
+
+from curses_td import make_engine
+from sweep import MAX_TICKS, BuildOrder, strategy_actions
+
+pytest.importorskip('numpy')
+
+
+def play_without_towers(backend, map_name):
+    engine = make_engine(backend, 1)
+    engine.setup_map(map_name, 'hard')
+    while engine.step():
+        pass
+    return engine
+
+
+@pytest.mark.parametrize('map_name', ['map1.txt', 'map2.txt', 'map3.txt',
+                                      'map4.txt', 'map5.txt'])
+def test_lost_game_ends_the_same(map_name):
+    python = play_without_towers('python', map_name)
+    vector = play_without_towers('numpy', map_name)
+    assert python.lifes <= 0
+    assert (vector.ticks, vector.lifes, vector.kills, len(vector.creeps)) == \
+        (python.ticks, python.lifes, python.kills, len(python.creeps))
+
+
+def test_game_stops_at_creep_taking_last_life():
+    engine = make_engine('python', 1)
+    engine.setup_map('map1.txt', 'hard')
+    while len(engine.creeps) < 4:
+        engine.step()
+    state = engine.snapshot()
+    exit_index = next(n for n, next_index in enumerate(engine.path_next)
+                      if next_index == n)
+    # three creeps reach exit in the same tick, the second takes last life
+    state['creeps'] = [(exit_index,) + values[1:] for values in state['creeps'][:3]] + \
+        state['creeps'][3:]
+    state['lifes'] = 2
+    results = []
+    for backend in ('python', 'numpy'):
+        engine = make_engine(backend)
+        engine.restore(state)
+        assert not engine.step()
+        results.append((engine.lifes, len(engine.creeps)))
+    assert results[0] == results[1] == (0, len(state['creeps']) - 2)
+
+
+def play_with_towers(backend, map_name, tower_types):
+    engine = make_engine(backend, 3)
+    engine.setup_map(map_name, 'medium')
+    # enough gold to have every tower type, ice included, from the start
+    engine.gold = 500
+    orders = [strategy_actions(engine, tower_type) for tower_type in tower_types]
+    actions = [action for actions in zip(*orders) for action in actions]
+    build_order = BuildOrder(actions)
+    trace = []
+    while engine.ticks < MAX_TICKS:
+        build_order.play(engine)
+        engine.skip_idle()
+        if not engine.step():
+            break
+        if engine.ticks % 100 == 0:
+            trace.append((engine.ticks, engine.level_round, engine.lifes,
+                          engine.gold, engine.kills, len(engine.creeps),
+                          sum(int(hp) for hp in engine.creeps.hp)
+                          if backend == 'numpy' else
+                          sum(creep.hp for creep in engine.creeps)))
+    return engine, trace
+
+
+@pytest.mark.parametrize('map_name', ['map1.txt', 'map3.txt', 'map5.txt'])
+def test_game_with_towers_plays_the_same(map_name):
+    python, python_trace = play_with_towers('python', map_name, 'icms')
+    vector, vector_trace = play_with_towers('numpy', map_name, 'icms')
+    assert len(python.towers) >= 4
+    assert {tower.tower_type for tower in python.towers} == set('icms')
+    assert python.kills
+    assert vector_trace == python_trace
+    assert (vector.ticks, vector.level_round, vector.lifes, vector.gold,
+            vector.kills) == (python.ticks, python.level_round, python.lifes,
+                              python.gold, python.kills)
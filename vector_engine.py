@@ -0,0 +1,297 @@
+""" NumPy structure-of-arrays combat backend for huge creep waves.
+
+VectorEngine plays by the same rules as GameEngine, but keeps creeps state
+in NumPy arrays and applies tower damage, ice slow, movement and kill
+rewards as batched array operations once per tick. NumPy is optional, it
+is needed only when this backend is used.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from curses_td import (ATTACK_SPEED_POINTS, BOSS_LIFES, CRIT_MULTIPLIER,
+                       EFFECTS, MOVE_SPEED_POINTS, Creep, ExitGame, GameEngine,
+                       TowerChainsaw, TowerIce, TowerSniper)
+
+
+class CreepArrays():
+
+    """ Creeps stored column-wise, alive creeps are first n rows in spawn order. """
+
+    FIELDS = {'path_index': 'int64', 'hp': 'int64', 'reward': 'int64',
+              'speed': 'float64', 'original_speed': 'float64',
+              'move_points': 'float64', 'boss': 'bool',
+              # strongest slow on creep and tick when it expires
+              'slow': 'float64', 'slow_expire': 'int64'}
+
+    def __init__(self, creep_path, capacity=64):
+        self.creep_path = creep_path
+        self.n = 0
+        for name, dtype in self.FIELDS.items():
+            setattr(self, '_' + name, np.zeros(capacity, dtype=dtype))
+
+    def __len__(self):
+        return self.n
+
+    def __getattr__(self, name):
+        """ Give views of alive part of arrays: creeps.hp, creeps.speed... """
+        if name in CreepArrays.FIELDS:
+            return getattr(self, '_' + name)[:self.n]
+        raise AttributeError(name)
+
+    def __iter__(self):
+        """ Yield Creep copies, used for drawing only. """
+        for i in range(self.n):
+            row, col = self.creep_path[self._path_index[i]]
+            creep = Creep(row, col, int(self._hp[i]), int(self._reward[i]),
+                          float(self._speed[i]), bool(self._boss[i]))
+            creep.path_index = int(self._path_index[i])
+            creep.move_points = float(self._move_points[i])
+            creep.original_speed = float(self._original_speed[i])
+            if self._slow[i]:
+                creep.effects = {'slow': [[float(self._slow[i]),
+                                           int(self._slow_expire[i])]]}
+            yield creep
+
+    def append(self, path_index, hp, reward, speed, boss):
+        if self.n == len(self._hp):
+            for name in self.FIELDS:
+                array = getattr(self, '_' + name)
+                setattr(self, '_' + name, np.concatenate([array, np.zeros_like(array)]))
+        i = self.n
+        self._path_index[i] = path_index
+        self._hp[i] = hp
+        self._reward[i] = reward
+        self._speed[i] = speed
+        self._original_speed[i] = speed
+        self._move_points[i] = 0
+        self._boss[i] = boss
+        self._slow[i] = 0
+        self.n += 1
+
+    def keep(self, mask):
+        """ Drop creeps where mask is False, keeping order of the rest. """
+        count = int(mask.sum())
+        for name in self.FIELDS:
+            array = getattr(self, '_' + name)
+            array[:count] = array[:self.n][mask]
+        self.n = count
+
+
+class VectorEngine(GameEngine):
+
+    """ GameEngine keeping creeps in NumPy arrays. """
+
+    def __init__(self, seed=None):
+        if np is None:
+            raise ImportError('numpy is required for vector engine')
+        super().__init__(seed)
+
+    def setup_field(self, gf, map_name, difficulty, maze=False, waves=None):
+        super().setup_field(gf, map_name, difficulty, maze, waves)
+        self.creeps = CreepArrays(self.creep_path)
+        self.next_indices = np.array(self.path_next, dtype='int64')
+        self.count_creeps()
+        self.tower_arrays = None
+        # earliest tick when some slow expires, None if no creep is slowed
+        self.next_expiry = None
+
+    def build_tower(self, tower, row, col):
+        super().build_tower(tower, row, col)
+        self.tower_arrays = None
+
+    def destroy_tower(self, row, col):
+        super().destroy_tower(row, col)
+        self.tower_arrays = None
+
+    def upgrade_tower(self, row, col):
+        super().upgrade_tower(row, col)
+        self.tower_arrays = None
+
+    def reroute(self, changed):
+        super().reroute(changed)
+        self.creeps.creep_path = self.creep_path
+        self.next_indices = np.array(self.path_next, dtype='int64')
+        self.tower_arrays = None
+
+    def remap_creeps(self, new_indices):
+        self.creeps.path_index[:] = np.array(new_indices, dtype='int64')[
+            self.creeps.path_index]
+
+    def count_creeps(self):
+        """ Number of creeps on every cell in array indexed by path index. """
+        self.creep_counts = np.bincount(self.creeps.path_index,
+                                        minlength=len(self.creep_path))
+
+    def creep_cells(self):
+        return {self.creep_path[i] for i in np.flatnonzero(self.creep_counts).tolist()}
+
+    def build_tower_arrays(self):
+        """ Stack towers coverage and stats into arrays, one row per tower. """
+        coverage = np.zeros((len(self.towers), len(self.creep_path)), dtype=bool)
+        for i, tower in enumerate(self.towers):
+            for first, last in self.creep_index.coverage[tower]:
+                coverage[i, first:last + 1] = True
+        area = np.array([isinstance(tower, (TowerChainsaw, TowerIce))
+                         for tower in self.towers], dtype=bool)
+        ice = np.array([isinstance(tower, TowerIce) for tower in self.towers],
+                       dtype=bool)
+        slow = np.array([getattr(tower, 'slow_points', 0) for tower in self.towers],
+                        dtype=float)
+        damage = np.array([tower.damage for tower in self.towers], dtype='int64')
+        self.tower_arrays = (coverage, area, ice, slow, damage)
+
+    def spawn_creep(self, spawn, template):
+        """ Spawn new creep from (hp, reward, speed, boss) template. """
+        self.creeps.append(spawn, *template)
+        self.creep_counts[spawn] += 1
+
+    def count_shots(self, has_target):
+        """ Advance towers attack timers like Tower.attack does, return shots. """
+        shots = np.zeros(len(self.towers), dtype='int64')
+        for i, tower in enumerate(self.towers):
+            if has_target[i]:
+                while tower.speed_points >= ATTACK_SPEED_POINTS:
+                    shots[i] += 1
+                    tower.speed_points -= ATTACK_SPEED_POINTS
+                tower.speed_points += tower.speed
+                tower._next_image()
+            else:
+                tower.image = 0
+        return shots
+
+    def attack_creeps(self):
+        """ All towers attack at once: creeps hp and speed updated in batch. """
+        if not self.towers or not len(self.creeps):
+            for tower in self.towers:
+                tower.image = 0
+            return
+        if self.tower_arrays is None:
+            self.build_tower_arrays()
+        coverage, area, ice, slow, damage = self.tower_arrays
+        creeps = self.creeps
+        in_range = coverage[:, creeps.path_index]
+        shots = self.count_shots(in_range.any(axis=1))
+        firing = shots > 0
+        hp_loss = np.zeros(len(creeps), dtype='int64')
+
+        hitting = area & firing
+        if hitting.any():
+            hp_loss += (damage[hitting] * shots[hitting]) @ in_range[hitting]
+            slowing = ice & firing
+            if slowing.any():
+                self.apply_slow(np.where(in_range[slowing],
+                                         slow[slowing][:, None], 0).max(axis=0))
+
+        # single target towers: furthest along the path, then closest to
+        # next move, then spawned first
+        aiming = np.flatnonzero(~area & firing)
+        if len(aiming):
+            key = creeps.path_index * 1024.0 + creeps.move_points
+            targets = np.where(in_range[aiming], key, -1.0).argmax(axis=1)
+            tower_damage = damage[aiming] * shots[aiming]
+            for n, i in enumerate(aiming):
+                tower = self.towers[i]
+                if isinstance(tower, TowerSniper):
+                    tower_damage[n] = 0
+                    for _ in range(shots[i]):
+                        chance = self.rng.randint(0, 100)
+                        tower_damage[n] += (tower.damage * CRIT_MULTIPLIER
+                                            if chance <= tower.crit_chance
+                                            else tower.damage)
+            np.add.at(hp_loss, targets, tower_damage)
+        creeps.hp[:] -= hp_loss
+
+    def apply_slow(self, slow):
+        """ Apply strongest slow to creeps by rule of EFFECTS['slow']. """
+        creeps = self.creeps
+        slowed = (slow > 0) & (slow >= creeps.slow)
+        if not slowed.any():
+            return
+        expire = self.ticks + EFFECTS['slow']['duration']
+        creeps.slow[slowed] = slow[slowed]
+        creeps.slow_expire[slowed] = expire
+        creeps.speed[slowed] = np.maximum(
+            creeps.original_speed[slowed] - slow[slowed], 0.1)
+        if self.next_expiry is None:
+            self.next_expiry = expire
+
+    def expire_effects(self):
+        """ Remove slow which ends at this tick, only when some is due. """
+        if self.next_expiry is None or self.next_expiry > self.ticks:
+            return
+        creeps = self.creeps
+        slowed = creeps.slow > 0
+        expired = slowed & (creeps.slow_expire <= self.ticks)
+        creeps.slow[expired] = 0
+        creeps.speed[expired] = creeps.original_speed[expired]
+        left = slowed & ~expired
+        self.next_expiry = int(creeps.slow_expire[left].min()) if left.any() else None
+
+    def remove_dead_creeps(self):
+        """ Remove killed creeps and pay reward for them. """
+        dead = self.creeps.hp <= 0
+        if dead.any():
+            self.kills += int(dead.sum())
+            self.gold += int(self.creeps.reward[dead].sum())
+            np.subtract.at(self.creep_counts, self.creeps.path_index[dead], 1)
+            self.creeps.keep(~dead)
+
+    def move_creeps(self):
+        """ Move all creeps to next cell in route. """
+        creeps = self.creeps
+        finished = self.next_indices[creeps.path_index] == creeps.path_index
+        # creeps which are moved, like in GameEngine creeps after the one
+        # which takes the last life stay where they are
+        active = ~finished
+        lethal = False
+        if finished.any():
+            exits = np.flatnonzero(finished)
+            lifes = self.lifes - np.cumsum(
+                np.where(creeps.boss[exits], BOSS_LIFES, 1))
+            if lifes[-1] <= 0:
+                lethal = True
+                n = int(np.argmax(lifes <= 0))
+                finished[exits[n] + 1:] = False
+                active[exits[n] + 1:] = False
+            else:
+                n = -1
+            self.lifes = int(lifes[n])
+        ready = active & (creeps.move_points >= MOVE_SPEED_POINTS)
+        moving = creeps.path_index[ready]
+        np.subtract.at(self.creep_counts, moving, 1)
+        creeps.path_index[ready] = self.next_indices[moving]
+        np.add.at(self.creep_counts, creeps.path_index[ready], 1)
+        creeps.move_points[ready] = 0
+        waiting = active & ~ready
+        creeps.move_points[waiting] += creeps.speed[waiting]
+        if finished.any():
+            np.subtract.at(self.creep_counts, creeps.path_index[finished], 1)
+            creeps.keep(~finished)
+        if lethal:
+            raise ExitGame
+
+    def restore_creeps(self, creeps):
+        fields = GameEngine.CREEP_FIELDS
+        for values in creeps:
+            creep = dict(zip(fields, values))
+            self.creeps.append(creep['path_index'], creep['hp'], creep['reward'],
+                               creep['speed'], creep['boss'])
+            i = len(self.creeps) - 1
+            self.creeps._original_speed[i] = creep['original_speed']
+            self.creeps._move_points[i] = creep['move_points']
+            for slow, expire in creep.get('effects', {}).get('slow', ()):
+                self.creeps._slow[i] = slow
+                self.creeps._slow_expire[i] = expire
+                if self.next_expiry is None or expire < self.next_expiry:
+                    self.next_expiry = expire
+
+    def is_start_free(self, spawn):
+        return not self.creep_counts[spawn]
+
+    @property
+    def boss_hp(self):
+        bosses = self.creeps.hp[self.creeps.boss]
+        return int(bosses[0]) if len(bosses) else 0